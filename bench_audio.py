@@ -0,0 +1,100 @@
+"""Benchmark getting a recorded utterance to the speech recognizer.
+
+Run from the repository root (the old path needs ffmpeg on PATH, as discord's MP3Sink does):
+
+    python bench_audio.py
+    python bench_audio.py --seconds 1 3 8 --iterations 20 --json results.json
+
+Compares the old path, where discord's MP3Sink encoded the recording to MP3 and speech_to_text decoded it with pydub,
+re-exported it as WAV and parsed that with sr.AudioFile, against UtteranceSink, which hands the recognizer the raw PCM
+it buffered. Both stop at the sr.AudioData that recognize_google is given. Reports milliseconds and bytes per utterance
+for each, and what the sink saves. Nothing touches the network.
+"""
+import argparse
+import asyncio
+import io
+import json
+import math
+import statistics
+import struct
+import time
+
+import speech_recognition as sr
+from pydub import AudioSegment
+
+from voice_sink import CHANNELS, FRAME_SIZE, SAMPLE_RATE, SAMPLE_WIDTH, UtteranceSink
+
+def make_utterance(seconds: float) -> bytes:
+    """Return seconds of a loud warbling tone as discord-format stereo PCM, followed by enough quiet to end it."""
+    samples = []
+    for i in range(int(SAMPLE_RATE * seconds)):
+        value = int(6000 * math.sin(i * 0.05) * (0.6 + 0.4 * math.sin(i * 0.0004)))
+        samples.append(struct.pack("<hh", value, value))
+    return b"".join(samples) + bytes(FRAME_SIZE * 30)
+
+def old_path(pcm: bytes) -> tuple[sr.AudioData, int]:
+    """Return the recognizer's input and the bytes of the MP3 the old path encoded."""
+    # what MP3Sink did when recording stopped
+    mp3 = io.BytesIO()
+    AudioSegment(pcm, sample_width=SAMPLE_WIDTH, frame_rate=SAMPLE_RATE, channels=CHANNELS).export(mp3, format="mp3")
+    mp3.seek(0)
+    encoded = mp3.getbuffer().nbytes
+
+    # what speech_to_text did with it
+    converted_audio = io.BytesIO()
+    AudioSegment.from_file(mp3).export(converted_audio, format="wav")
+    recognizer = sr.Recognizer()
+    with sr.AudioFile(converted_audio) as source:
+        return recognizer.record(source), encoded
+
+def sink_path(pcm: bytes) -> sr.AudioData:
+    """Feed pcm through an UtteranceSink 20 ms at a time, as the voice client does, and return the utterance it hands over."""
+    utterances = []
+    loop = asyncio.new_event_loop()
+    sink = UtteranceSink(lambda user, audio: utterances.append(audio), loop)
+    for start in range(0, len(pcm), FRAME_SIZE):
+        sink.write(pcm[start:start + FRAME_SIZE], 1)
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+    return utterances[0]
+
+def measure(seconds: float, iterations: int) -> dict:
+    pcm = make_utterance(seconds)
+    old_times, new_times = [], []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        old_audio, encoded = old_path(pcm)
+        old_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        new_audio = sink_path(pcm)
+        new_times.append(time.perf_counter() - start)
+
+    old_ms = statistics.median(old_times) * 1000
+    new_ms = statistics.median(new_times) * 1000
+    # bytes the old path held: the stereo recording, the MP3, and the decoded WAV before sr.AudioFile read it
+    old_bytes = len(pcm) + encoded + len(old_audio.frame_data) + 44
+    new_bytes = len(new_audio.frame_data)
+    return {"seconds": seconds, "old_ms": old_ms, "sink_ms": new_ms, "saved_ms": old_ms - new_ms,
+            "old_bytes": old_bytes, "sink_bytes": new_bytes, "saved_bytes": old_bytes - new_bytes}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark getting a recorded utterance to the speech recognizer.")
+    parser.add_argument("--seconds", type=float, nargs="+", default=[1.0, 2.5, 5.0], help="utterance lengths to time")
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    results = [measure(seconds, args.iterations) for seconds in args.seconds]
+
+    print(f"{'seconds':>8} {'old ms':>8} {'sink ms':>8} {'saved ms':>9} {'old KB':>8} {'sink KB':>8} {'saved KB':>9}")
+    for result in results:
+        print(f"{result['seconds']:>8.1f} {result['old_ms']:>8.1f} {result['sink_ms']:>8.1f} {result['saved_ms']:>9.1f} "
+              f"{result['old_bytes'] / 1024:>8.0f} {result['sink_bytes'] / 1024:>8.0f} {result['saved_bytes'] / 1024:>9.0f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""Check the move parsers against a corpus of inputs and benchmark them.
+
+Run from the repository root:
+
+    python bench_parser.py
+    python bench_parser.py --iterations 20 --json results.json
+    python bench_parser.py --baseline results.json --fail-under 1.0
+
+Each line of the corpus (rsc/parser_corpus.jsonl by default) is a position, what the player typed ("input") or what
+speech recognition heard ("alternatives", as returned by recognize_google(show_all=True)), and the move the bot should
+play in UCI, or null if it should play nothing. Typed input goes through DiscordChessGame.parse_move, the same path as
+try_move; recognition results go through choose_speech_move, the same path as try_speechrec_move. Nothing touches the
+network.
+"""
+import argparse
+import json
+import time
+from types import SimpleNamespace
+
+import chess
+
+from chess_functions import ChessPlayer, DiscordChessGame
+
+def load_corpus(path: str) -> list:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def make_game(fen: str) -> DiscordChessGame:
+    """Create a game at fen with placeholder players; nothing the parsers call talks to Discord."""
+    white = ChessPlayer(SimpleNamespace(id=1, name="white", display_name="white"))
+    black = ChessPlayer(SimpleNamespace(id=2, name="black", display_name="black"))
+    game = DiscordChessGame(channel=0, white=white, black=black)
+    game.game = chess.Board(fen)
+    return game
+
+def parse_case(game: DiscordChessGame, case: dict) -> str | None:
+    """Return the move the bot would play for case in UCI, or None if it would play nothing."""
+    if "alternatives" in case:
+        move = game.choose_speech_move(case["alternatives"])
+        return move.uci() if isinstance(move, chess.Move) else None
+    try:
+        return game.parse_move(case["input"]).uci()
+    except ValueError:
+        return None
+
+def check(corpus: list) -> tuple[dict, list]:
+    """Parse every case once and return (kind -> [passed, total], failures)."""
+    kinds = {}
+    failures = []
+    for case in corpus:
+        got = parse_case(make_game(case["fen"]), case)
+        counts = kinds.setdefault(case["kind"], [0, 0])
+        counts[1] += 1
+        if got == case["expected"]:
+            counts[0] += 1
+        else:
+            failures.append((case, got))
+    return kinds, failures
+
+def measure(corpus: list, iterations: int) -> dict:
+    """Return parses per second over the corpus, cold (the first parse in a position, which builds its move index)
+    and warm (the index already built)."""
+    games = [make_game(case["fen"]) for case in corpus]
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for game, case in zip(games, corpus):
+            # forget the index so every parse pays for building it, like the first message after a move
+            game._move_index = None
+            parse_case(game, case)
+    cold = iterations * len(corpus) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for game, case in zip(games, corpus):
+            parse_case(game, case)
+    warm = iterations * len(corpus) / (time.perf_counter() - start)
+
+    return {"cold_parses_per_second": cold, "warm_parses_per_second": warm}
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the move parsers against a corpus and benchmark them.")
+    parser.add_argument("--corpus", default="rsc/parser_corpus.jsonl")
+    parser.add_argument("--iterations", type=int, default=50, help="passes over the corpus for each timing")
+    parser.add_argument("--json", help="write the results to this file, to use as a later --baseline")
+    parser.add_argument("--baseline", help="compare against results previously written with --json")
+    parser.add_argument("--fail-under", type=float, help="exit with an error if accuracy is below this fraction")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    kinds, failures = check(corpus)
+    passed = sum(counts[0] for counts in kinds.values())
+    results = {"cases": len(corpus), "passed": passed, "accuracy": passed / len(corpus), **measure(corpus, args.iterations)}
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    print(f"{'kind':<32} {'passed':>8}")
+    for kind, (kind_passed, total) in kinds.items():
+        print(f"{kind:<32} {kind_passed:>3}/{total:<4}")
+    for case, got in failures:
+        print(f"FAIL {case['kind']}: {case.get('input', case.get('alternatives'))!r} at {case['fen']} gave {got}, expected {case['expected']}")
+
+    for key in ("accuracy", "cold_parses_per_second", "warm_parses_per_second"):
+        line = f"{key}: {results[key]:.3f}" if key == "accuracy" else f"{key}: {results[key]:.0f}"
+        if baseline and key in baseline:
+            line += f"  (baseline {baseline[key]:.3f})" if key == "accuracy" else f"  ({results[key] / baseline[key]:.2f}x baseline)"
+        print(line)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.fail_under is not None and results["accuracy"] < args.fail_under:
+        raise SystemExit(f"accuracy {results['accuracy']:.3f} is below {args.fail_under}")
+
+if __name__ == "__main__":
+    main()
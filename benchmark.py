@@ -0,0 +1,214 @@
+"""Benchmark board rendering and embed construction.
+
+Run from the repository root (board_image loads its sprites from rsc/):
+
+    python benchmark.py
+    python benchmark.py --sizes 400 800 --formats jpeg png --iterations 200 --json results.json
+    python benchmark.py --baseline results.json
+
+Every case renders each position in the corpus, once from white's side and once mirrored, and reports renders per second,
+p50/p99 latency, the peak memory Python allocated for one pass over the corpus and the peak resident memory of the process
+while the case ran. Nothing touches the network.
+"""
+import argparse
+import gc
+import json
+import resource
+import statistics
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import chess
+
+import board_image
+from board_image import ChessBoardImage, IncrementalBoardRenderer, board_image_cache, get_pieces, render_board
+from chess_functions import ChessPlayer, DiscordChessGame
+
+# numpy is optional; without it the numpy backend is left out
+try:
+    import numpy_board_image
+    from numpy_board_image import NumpyChessBoardImage
+except ImportError:
+    NumpyChessBoardImage = None
+
+# (name, fen before the last move, last move in uci)
+CORPUS = [
+    ("opening: start", chess.STARTING_FEN, "e2e4"),
+    ("opening: ruy lopez", "r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3", "f1b5"),
+    ("opening: sicilian najdorf", "rnbqkb1r/1p2pppp/p2p1n2/8/3NP3/2N5/PPP2PPP/R1BQKB1R w KQkq - 0 6", "c1g5"),
+    ("opening: queen's gambit", "rnbqkbnr/ppp1pppp/8/3p4/3P4/8/PPP1PPPP/RNBQKBNR w KQkq - 0 2", "c2c4"),
+    ("middlegame: crowded", "r2q1rk1/pp1nbppp/2p1pn2/3p4/2PP4/2NBPN2/PP3PPP/R2QK2R w KQ - 0 9", "e1g1"),
+    ("middlegame: tactical", "r1b2rk1/2q1bppp/p2ppn2/1p6/3NPP2/2N1B3/PPPQB1PP/2KR3R w - - 0 13", "g2g4"),
+    ("middlegame: open", "2rq1rk1/pb3ppp/1p2pn2/8/2BP4/P1N2Q2/1P3PPP/2R2RK1 b - - 0 17", "d8d6"),
+    ("endgame: rook", "8/5pk1/6p1/R7/5P2/6PK/r7/8 w - - 0 45", "a5a7"),
+    ("endgame: king and pawn", "8/8/4k3/8/4PK2/8/8/8 w - - 0 60", "f4e3"),
+    ("endgame: promotion", "8/4P1k1/8/8/8/8/6K1/8 w - - 0 70", "e7e8q"),
+]
+
+def corpus_positions():
+    """Yield (name, board) for every corpus position, with the last move played so it is highlighted."""
+    for name, fen, uci in CORPUS:
+        board = chess.Board(fen)
+        board.push_uci(uci)
+        yield name, board
+
+def lastmove_of(board: chess.Board) -> tuple:
+    move = board.move_stack[-1]
+    return (move.from_square, move.to_square)
+
+def make_game(board: chess.Board) -> DiscordChessGame:
+    """Create a game on board with placeholder players; nothing the benchmark calls talks to Discord."""
+    white = ChessPlayer(SimpleNamespace(id=1, name="white", display_name="white"))
+    black = ChessPlayer(SimpleNamespace(id=2, name="black", display_name="black"))
+    game = DiscordChessGame(channel=0, white=white, black=black)
+    game.game = board
+    return game
+
+def clear_render_caches():
+    """Forget everything board_image caches so a case starts cold."""
+    board_image._background_cache.clear()
+    board_image._label_stamp_cache.clear()
+    board_image._scaled_piece_cache.clear()
+    if NumpyChessBoardImage:
+        numpy_board_image._checkerboard_cache.clear()
+        numpy_board_image._sprite_atlas_cache.clear()
+        numpy_board_image._label_cache.clear()
+    board_image_cache.clear()
+
+def reset_peak_rss():
+    """Reset the kernel's record of peak resident memory for this process, where Linux allows it."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def peak_rss_kb() -> int:
+    """Return the peak resident memory of this process in kilobytes since it was last reset."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux but can't be reset, so it is the peak of the whole run
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def measure(name: str, calls: list, iterations: int) -> dict:
+    """Call each function in calls iterations times in total, round robin, and summarize the latency of every call.
+
+    Memory is measured on a separate pass over calls, since tracing allocations slows every call down."""
+    # warm up caches that the case is not trying to measure
+    for call in calls:
+        call()
+
+    gc.collect()
+    reset_peak_rss()
+    latencies = []
+    start = time.perf_counter()
+    for i in range(iterations):
+        call = calls[i % len(calls)]
+        call_start = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - call_start)
+    elapsed = time.perf_counter() - start
+    rss = peak_rss_kb()
+
+    tracemalloc.start()
+    for call in calls:
+        call()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        "case": name,
+        "renders_per_second": iterations / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+        "peak_python_kb": peak / 1024,
+        "peak_rss_kb": rss,
+    }
+
+def run(sizes: list, formats: list, iterations: int, quality: int = 75) -> list:
+    pieces = get_pieces()
+    boards = list(corpus_positions())
+    orientations = [(name, board, mirror) for name, board in boards for mirror in (False, True)]
+    results = []
+
+    for size in sizes:
+        results.append(measure(f"ChessBoardImage size={size}", [
+            (lambda board=board, mirror=mirror: ChessBoardImage(pieces, board.piece_map(), lastmove_of(board), mirror, size))
+            for _, board, mirror in orientations
+        ], iterations))
+
+        if NumpyChessBoardImage:
+            results.append(measure(f"NumpyChessBoardImage size={size}", [
+                (lambda board=board, mirror=mirror: NumpyChessBoardImage(pieces, board.piece_map(), lastmove_of(board), mirror, size))
+                for _, board, mirror in orientations
+            ], iterations))
+
+        # replays the corpus in order, so consecutive positions are unrelated; this is the incremental renderer's worst case
+        renderer = IncrementalBoardRenderer(pieces)
+        results.append(measure(f"IncrementalBoardRenderer size={size}", [
+            (lambda board=board, mirror=mirror: renderer.render(board.piece_map(), lastmove_of(board), mirror, size))
+            for _, board, mirror in orientations
+        ], iterations))
+
+        for format in formats:
+            results.append(measure(f"render_board size={size} format={format}", [
+                (lambda board=board, mirror=mirror: render_board(board.board_fen(), lastmove_of(board), mirror, size, format, quality))
+                for _, board, mirror in orientations
+            ], iterations))
+
+            games = [make_game(board) for _, board in boards]
+            board_image_cache.resize(0)
+            results.append(measure(f"get_board_image size={size} format={format} uncached", [
+                (lambda game=game: game.get_board_image(size, format, quality)) for game in games
+            ], iterations))
+            board_image_cache.resize(len(games))
+            results.append(measure(f"get_board_image size={size} format={format} cached", [
+                (lambda game=game: game.get_board_image(size, format, quality)) for game in games
+            ], iterations))
+
+    board_image_cache.resize(0)
+    games = [make_game(board) for _, board in boards]
+    results.append(measure("get_embed uncached", [game.get_embed for game in games], iterations))
+
+    return results
+
+def print_results(results: list, baseline: dict = None):
+    print(f"{'case':<52} {'renders/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'py peak KB':>11} {'peak RSS KB':>12}")
+    for result in results:
+        line = f"{result['case']:<52} {result['renders_per_second']:>10.1f} {result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f} {result['peak_python_kb']:>11.1f} {result['peak_rss_kb']:>12}"
+        if baseline and result["case"] in baseline:
+            line += f"  ({result['renders_per_second'] / baseline[result['case']]['renders_per_second']:.2f}x baseline)"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark board rendering and embed construction.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[400, 800])
+    parser.add_argument("--formats", nargs="+", default=["jpeg", "png", "webp"])
+    parser.add_argument("--quality", type=int, default=75, help="jpeg and webp quality")
+    parser.add_argument("--iterations", type=int, default=100, help="calls per case")
+    parser.add_argument("--json", help="write the results to this file, to use as a later --baseline")
+    parser.add_argument("--baseline", help="compare against results previously written with --json")
+    args = parser.parse_args()
+
+    clear_render_caches()
+    results = run(args.sizes, args.formats, args.iterations, args.quality)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {result["case"]: result for result in json.load(f)}
+    print_results(results, baseline)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,9 @@
 from PIL import Image, ImageDraw, ImageFont
+from collections import OrderedDict
+import io
+import threading
 
-from chess import Piece, SQUARE_NAMES
+from chess import BaseBoard, Piece, SQUARE_NAMES, square_file, square_rank
 
 def generate_piece_images() -> dict:
     """Create a dictionary of PIL Image objects corresponding to each chess piece keyed by FEN notation of the piece."""
@@ -24,153 +27,327 @@ def generate_piece_images() -> dict:
     out['p'] = spritesheet.crop((1000, 200, 1200, 400))
     return out
 
-class ChessBoardImage:
-    def __init__(self, pieces: dict, board_position: dict, lastmove: tuple = (), mirror = False, size=800, dark: tuple = (110, 109, 107), light: tuple = (144, 143, 141)):
-        def get_pixels_of_coords(coordinates: str):
-            """Get the pixel location of chess notation coordinates (ie. a8 should return (0,0) and f3 should return ((size/8)*5, (size/8)*5))"""
-            out_x = 0
-            out_y = 0
-            
-            if mirror:
-                match coordinates[0]:
-                    case "h":
-                        out_x = 0
-                    case "g":
-                        out_x = size//8
-                    case "f":
-                        out_x = 2*size//8
-                    case "e":
-                        out_x = 3*size//8
-                    case "d":
-                        out_x = 4*size//8
-                    case "c":
-                        out_x = 5*size//8
-                    case "b":
-                        out_x = 6*size//8
-                    case "a":
-                        out_x = 7*size//8
-
-                match coordinates[1]:
-                    case "8":
-                        out_y = 7*size//8
-                    case "7":
-                        out_y = 6*size//8
-                    case "6":
-                        out_y = 5*size//8
-                    case "5":
-                        out_y = 4*size//8
-                    case "4":
-                        out_y = 3*size//8
-                    case "3":
-                        out_y = 2*size//8
-                    case "2":
-                        out_y = size//8
-                    case "1":
-                        out_y = 0
-            else:
-                match coordinates[0]:
-                    case "a":
-                        out_x = 0
-                    case "b":
-                        out_x = size//8
-                    case "c":
-                        out_x = 2*size//8
-                    case "d":
-                        out_x = 3*size//8
-                    case "e":
-                        out_x = 4*size//8
-                    case "f":
-                        out_x = 5*size//8
-                    case "g":
-                        out_x = 6*size//8
-                    case "h":
-                        out_x = 7*size//8
-
-                match coordinates[1]:
-                    case "8":
-                        out_y = 0
-                    case "7":
-                        out_y = size//8
-                    case "6":
-                        out_y = 2*size//8
-                    case "5":
-                        out_y = 3*size//8
-                    case "4":
-                        out_y = 4*size//8
-                    case "3":
-                        out_y = 5*size//8
-                    case "2":
-                        out_y = 6*size//8
-                    case "1":
-                        out_y = 7*size//8
-
-            return (out_x, out_y)
-
-        # draw image with designated size and additional 10% for borders
-        self.img = Image.new(mode="RGB", size=(size,size), color=(0,0,0))
-        board = ImageDraw.Draw(self.img, "RGBA")
+def get_pixels_of_coords(coordinates: str, size: int = 800, mirror: bool = False) -> tuple:
+    """Get the pixel location of chess notation coordinates (ie. a8 should return (0,0) and f3 should return ((size/8)*5, (size/8)*5))"""
+    out_x = 0
+    out_y = 0
+
+    if mirror:
+        match coordinates[0]:
+            case "h":
+                out_x = 0
+            case "g":
+                out_x = size//8
+            case "f":
+                out_x = 2*size//8
+            case "e":
+                out_x = 3*size//8
+            case "d":
+                out_x = 4*size//8
+            case "c":
+                out_x = 5*size//8
+            case "b":
+                out_x = 6*size//8
+            case "a":
+                out_x = 7*size//8
+
+        match coordinates[1]:
+            case "8":
+                out_y = 7*size//8
+            case "7":
+                out_y = 6*size//8
+            case "6":
+                out_y = 5*size//8
+            case "5":
+                out_y = 4*size//8
+            case "4":
+                out_y = 3*size//8
+            case "3":
+                out_y = 2*size//8
+            case "2":
+                out_y = size//8
+            case "1":
+                out_y = 0
+    else:
+        match coordinates[0]:
+            case "a":
+                out_x = 0
+            case "b":
+                out_x = size//8
+            case "c":
+                out_x = 2*size//8
+            case "d":
+                out_x = 3*size//8
+            case "e":
+                out_x = 4*size//8
+            case "f":
+                out_x = 5*size//8
+            case "g":
+                out_x = 6*size//8
+            case "h":
+                out_x = 7*size//8
+
+        match coordinates[1]:
+            case "8":
+                out_y = 0
+            case "7":
+                out_y = size//8
+            case "6":
+                out_y = 2*size//8
+            case "5":
+                out_y = 3*size//8
+            case "4":
+                out_y = 4*size//8
+            case "3":
+                out_y = 5*size//8
+            case "2":
+                out_y = 6*size//8
+            case "1":
+                out_y = 7*size//8
+
+    return (out_x, out_y)
 
-        # draw the squares of the chess board
+def get_square_cell(square: int, mirror: bool = False) -> tuple:
+    """Get the (column, row) a square is drawn in, counted from the top left of the image."""
+    if mirror:
+        return (7 - square_file(square), square_rank(square))
+    return (square_file(square), 7 - square_rank(square))
+
+def get_square_box(square: int, size: int = 800, mirror: bool = False) -> tuple:
+    """Get the (left, upper, right, lower) pixel box a square is drawn in; boxes of neighbouring squares meet without gaps or overlap."""
+    column, row = get_square_cell(square, mirror)
+    return (column*size//8, row*size//8, (column+1)*size//8, (row+1)*size//8)
+
+# caches shared by every render; boards only ever use a handful of sizes, so these stay small
+_background_cache: dict = {}
+_label_stamp_cache: dict = {}
+_scaled_piece_cache: dict = {}
+
+def get_board_background(size: int = 800, dark: tuple = (110, 109, 107), light: tuple = (144, 143, 141)) -> Image.Image:
+    """Return the empty checkerboard for the given size and colors, drawing it only the first time it is requested. Do not modify the returned image; copy it."""
+    key = (size, dark, light)
+    background = _background_cache.get(key)
+    if background is None:
+        background = Image.new(mode="RGB", size=(size,size), color=(0,0,0))
+        board = ImageDraw.Draw(background)
+
+        # draw the squares of the chess board; a8 is always light, so the pattern does not depend on orientation
         for i in range(8):
-            # alternate colors based on row
-            if i % 2 == 0:
-                board.rectangle(xy = [(i*size/8, 0), ((i*size/8)+size/8, size/8)], fill=light, outline = None)
-                board.rectangle(xy = [(i*size/8, 1*size/8), ((i*size/8)+size/8, 2*size/8)], fill=dark, outline = None)
-                board.rectangle(xy = [(i*size/8, 2*size/8), ((i*size/8)+size/8, 3*size/8)], fill=light, outline = None)
-                board.rectangle(xy = [(i*size/8, 3*size/8), ((i*size/8)+size/8, 4*size/8)], fill=dark, outline = None)
-                board.rectangle(xy = [(i*size/8, 4*size/8), ((i*size/8)+size/8, 5*size/8)], fill=light, outline = None)
-                board.rectangle(xy = [(i*size/8, 5*size/8), ((i*size/8)+size/8, 6*size/8)], fill=dark, outline = None)
-                board.rectangle(xy = [(i*size/8, 6*size/8), ((i*size/8)+size/8, 7*size/8)], fill=light, outline = None)
-                board.rectangle(xy = [(i*size/8, 7*size/8), ((i*size/8)+size/8, 8*size/8)], fill=dark, outline = None)
-            else:
-                board.rectangle(xy = [(i*size/8, 0), ((i*size/8)+size/8, size/8)], fill=dark, outline = None)
-                board.rectangle(xy = [(i*size/8, 1*size/8), ((i*size/8)+size/8, 2*size/8)], fill=light, outline = None)
-                board.rectangle(xy = [(i*size/8, 2*size/8), ((i*size/8)+size/8, 3*size/8)], fill=dark, outline = None)
-                board.rectangle(xy = [(i*size/8, 3*size/8), ((i*size/8)+size/8, 4*size/8)], fill=light, outline = None)
-                board.rectangle(xy = [(i*size/8, 4*size/8), ((i*size/8)+size/8, 5*size/8)], fill=dark, outline = None)
-                board.rectangle(xy = [(i*size/8, 5*size/8), ((i*size/8)+size/8, 6*size/8)], fill=light, outline = None)
-                board.rectangle(xy = [(i*size/8, 6*size/8), ((i*size/8)+size/8, 7*size/8)], fill=dark, outline = None)
-                board.rectangle(xy = [(i*size/8, 7*size/8), ((i*size/8)+size/8, 8*size/8)], fill=light, outline = None)
-    
+            for j in range(8):
+                # alternate colors based on row
+                fill = light if (i + j) % 2 == 0 else dark
+                board.rectangle(xy = [(i*size/8, j*size/8), ((i*size/8)+size/8, (j+1)*size/8)], fill=fill, outline = None)
+
+        _background_cache[key] = background
+    return background
+
+def get_label_stamps(size: int = 800, mirror: bool = False) -> dict:
+    """Return the file and rank markers as (color, box, mask) stamps to be pasted with Image.paste(color, box, mask), keyed by the (column, row) of the square they are drawn on.
+
+    The markers are kept separate from the background so they can be stamped on top of pieces and highlights, as they always have been."""
+    key = (size, mirror)
+    stamps = _label_stamp_cache.get(key)
+    if stamps is None:
+        light_mask = Image.new(mode="L", size=(size,size), color=0)
+        dark_mask = Image.new(mode="L", size=(size,size), color=0)
+        light_text = ImageDraw.Draw(light_mask)
+        dark_text = ImageDraw.Draw(dark_mask)
+
         outline_font = ImageFont.truetype("rsc/DejaVuSans.ttf", size=size//25)
 
-        dark_text = (0,0,0)
-        light_text = (255,255,255)
-        
+        files = "abcdefgh" if not mirror else "hgfedcba"
+        ranks = "87654321" if not mirror else "12345678"
+        for i in range(8):
+            # draw file markers; light text on even files, dark text on odd files
+            (light_text if i % 2 == 0 else dark_text).text(xy = ((i+1)*size/8-size//30, size-size//20), text = files[i], align = "center", font = outline_font, fill = 255)
+            # draw rank markers; dark text on even ranks, light text on odd ranks
+            (dark_text if i % 2 == 0 else light_text).text(xy = (size//200, i*size/8), text = ranks[i], align = "center", font = outline_font, fill = 255)
+
+        # cut the markers into per-square stamps so that renders only paste the few pixels that actually hold text
+        stamps = {}
+        for color, mask in ((ChessBoardImage.light_text, light_mask), (ChessBoardImage.dark_text, dark_mask)):
+            for x in range(8):
+                for y in range(8):
+                    square = (x*size//8, y*size//8, (x+1)*size//8, (y+1)*size//8)
+                    bbox = mask.crop(square).getbbox()
+                    if bbox:
+                        box = (square[0]+bbox[0], square[1]+bbox[1], square[0]+bbox[2], square[1]+bbox[3])
+                        stamps.setdefault((x, y), []).append((color, box, mask.crop(box)))
+
+        _label_stamp_cache[key] = stamps
+    return stamps
+
+def get_scaled_pieces(pieces: dict, size: int = 800) -> dict:
+    """Return the piece images in pieces resized to fit a square of a board of the given size, resizing them only the first time they are requested."""
+    key = (id(pieces), size)
+    scaled = _scaled_piece_cache.get(key)
+    if scaled is None:
+        scaled = {symbol: image.resize((size//8, size//8)) for symbol, image in pieces.items()}
+        _scaled_piece_cache[key] = scaled
+    return scaled
+
+class ChessBoardImage:
+    # color of the last move highlight, blended over the square
+    highlight = (114, 137, 218, 127)
+    dark_text = (0,0,0)
+    light_text = (255,255,255)
+
+    def __init__(self, pieces: dict, board_position: dict, lastmove: tuple = (), mirror = False, size=800, dark: tuple = (110, 109, 107), light: tuple = (144, 143, 141)):
+        # start from a copy of the cached empty board
+        self.img = get_board_background(size, dark, light).copy()
+        board = ImageDraw.Draw(self.img, "RGBA")
+
         # highlight last move squares
-        if lastmove != ():
-            coords_1 = get_pixels_of_coords(SQUARE_NAMES[lastmove[0]])
-            board.rectangle(xy = [coords_1, (coords_1[0]+size//8, coords_1[1]+size//8)], fill=(114, 137, 218, 127), outline = None)
-            coords_2 = get_pixels_of_coords(SQUARE_NAMES[lastmove[1]])
-            board.rectangle(xy = [coords_2, (coords_2[0]+size//8, coords_2[1]+size//8)], fill=(114, 137, 218, 127), outline = None)
+        for square in lastmove:
+            coords = get_pixels_of_coords(SQUARE_NAMES[square], size, mirror)
+            board.rectangle(xy = [coords, (coords[0]+size//8-1, coords[1]+size//8-1)], fill=self.highlight, outline = None)
 
         # draw each peice image
+        scaled_pieces = get_scaled_pieces(pieces, size)
         for piece in board_position:
-            piece_image = pieces[f'{board_position[piece].symbol()}'].resize((size//8, size//8))
-            self.img.paste(piece_image, get_pixels_of_coords(SQUARE_NAMES[piece]), piece_image)
-
-        # draw file markers
-        board.text(xy = (1*size/8-size//30, size-size//20), text = "a" if not mirror else "h", align = "center", font = outline_font, fill = light_text)
-        board.text(xy = (2*size/8-size//30, size-size//20), text = "b" if not mirror else "g", align = "center", font = outline_font, fill = dark_text)
-        board.text(xy = (3*size/8-size//30, size-size//20), text = "c" if not mirror else "f", align = "center", font = outline_font, fill = light_text)
-        board.text(xy = (4*size/8-size//30, size-size//20), text = "d" if not mirror else "e", align = "center", font = outline_font, fill = dark_text)
-        board.text(xy = (5*size/8-size//30, size-size//20), text = "e" if not mirror else "d", align = "center", font = outline_font, fill = light_text)
-        board.text(xy = (6*size/8-size//30, size-size//20), text = "f" if not mirror else "c", align = "center", font = outline_font, fill = dark_text)
-        board.text(xy = (7*size/8-size//30, size-size//20), text = "g" if not mirror else "b", align = "center", font = outline_font, fill = light_text)
-        board.text(xy = (8*size/8-size//30, size-size//20), text = "h" if not mirror else "a", align = "center", font = outline_font, fill = dark_text)
-
-        # draw rank markers
-        board.text(xy = (size//200, 0), text = "8" if not mirror else "1", align = "center", font = outline_font, fill = dark_text)
-        board.text(xy = (size//200, 1*size/8), text = "7" if not mirror else "2", align = "center", font = outline_font, fill = light_text)
-        board.text(xy = (size//200, 2*size/8), text = "6" if not mirror else "3", align = "center", font = outline_font, fill = dark_text)
-        board.text(xy = (size//200, 3*size/8), text = "5" if not mirror else "4", align = "center", font = outline_font, fill = light_text)
-        board.text(xy = (size//200, 4*size/8), text = "4" if not mirror else "5", align = "center", font = outline_font, fill = dark_text)
-        board.text(xy = (size//200, 5*size/8), text = "3" if not mirror else "6", align = "center", font = outline_font, fill = light_text)
-        board.text(xy = (size//200, 6*size/8), text = "2" if not mirror else "7", align = "center", font = outline_font, fill = dark_text)
-        board.text(xy = (size//200, 7*size/8), text = "1" if not mirror else "8", align = "center", font = outline_font, fill = light_text)
-
-pieces = generate_piece_images()
+            piece_image = scaled_pieces[board_position[piece].symbol()]
+            self.img.paste(piece_image, get_pixels_of_coords(SQUARE_NAMES[piece], size, mirror), piece_image)
+
+        # draw file and rank markers over everything else
+        for stamps in get_label_stamps(size, mirror).values():
+            for color, box, mask in stamps:
+                self.img.paste(color, box, mask)
+
+class IncrementalBoardRenderer:
+    """Renders successive positions of one game, keeping the last frame for each orientation at the current size and repainting only the squares that changed since it.
+
+    Produces the same images as ChessBoardImage."""
+    def __init__(self, pieces: dict, dark: tuple = (110, 109, 107), light: tuple = (144, 143, 141), image_class = ChessBoardImage):
+        self.pieces = pieces
+        # draws the first frame of each orientation
+        self.image_class = image_class
+        self.dark = dark
+        self.light = light
+        # (mirror, size) -> (frame, board_position, lastmove)
+        self.frames = {}
+        # squares repainted by the last render, or None if it drew the whole board
+        self.dirty: set | None = None
+        # frames are reused between renders, so hold this from rendering until the frame has been encoded
+        self.lock = threading.Lock()
+
+    def render(self, board_position: dict, lastmove: tuple = (), mirror = False, size=800) -> Image.Image:
+        """Return an image of board_position. The image is reused by later renders, so copy it before modifying it."""
+        previous = self.frames.get((mirror, size))
+        if previous is None:
+            # the board size changed; frames of other sizes won't be repainted again soon, so don't hold on to them
+            for key in [key for key in self.frames if key[1] != size]:
+                del self.frames[key]
+            frame = self.image_class(self.pieces, board_position, lastmove, mirror, size, self.dark, self.light).img
+            dirty = None
+        else:
+            frame, previous_position, previous_lastmove = previous
+
+            # squares whose piece changed, plus squares that gained or lost the last move highlight
+            dirty = set(lastmove) ^ set(previous_lastmove)
+            for square in previous_position.keys() | board_position.keys():
+                if previous_position.get(square) != board_position.get(square):
+                    dirty.add(square)
+
+            for square in dirty:
+                self.repaint_square(frame, square, board_position, lastmove, mirror, size)
+
+        self.frames[(mirror, size)] = (frame, board_position, lastmove)
+        self.dirty = dirty
+        return frame
+
+    def repaint_square(self, frame: Image.Image, square: int, board_position: dict, lastmove: tuple, mirror: bool, size: int):
+        """Redraw a single square of frame from scratch, layering it the same way ChessBoardImage does."""
+        column, row = get_square_cell(square, mirror)
+        box = get_square_box(square, size, mirror)
+
+        frame.paste(get_board_background(size, self.dark, self.light).crop(box), box)
+
+        if square in lastmove:
+            ImageDraw.Draw(frame, "RGBA").rectangle(xy = [box[:2], (box[0]+size//8-1, box[1]+size//8-1)], fill=ChessBoardImage.highlight, outline = None)
+
+        piece = board_position.get(square)
+        if piece:
+            piece_image = get_scaled_pieces(self.pieces, size)[piece.symbol()]
+            frame.paste(piece_image, box[:2], piece_image)
+
+        for color, stamp_box, mask in get_label_stamps(size, mirror).get((column, row), ()):
+            frame.paste(color, stamp_box, mask)
+
+def render_board(board_fen: str, lastmove: tuple = (), mirror = False, size=800, format="jpeg", quality=75, renderer: IncrementalBoardRenderer = None, image_class = ChessBoardImage) -> bytes:
+    """Render the position described by board_fen with renderer, or with a fresh image_class if there is none, and return the encoded image.
+
+    Only takes picklable arguments so it can run in a worker process; a renderer can only be passed when rendering in this process."""
+    board_position = BaseBoard(board_fen).piece_map()
+    img_io = io.BytesIO()
+    if renderer is not None:
+        with renderer.lock:
+            renderer.render(board_position, lastmove, mirror, size).save(img_io, format, quality=quality)
+    else:
+        image_class(get_pieces(), board_position, lastmove, mirror, size).img.save(img_io, format, quality=quality)
+    return img_io.getvalue()
+
+# image formats boards can be uploaded as, and the file extension of each
+IMAGE_FORMATS = {"jpeg": "jpg", "png": "png", "webp": "webp"}
+
+class BoardImageCache:
+    """Least-recently-used cache of encoded board images, shared between games so repeated positions skip rendering and encoding entirely."""
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self.images: OrderedDict[tuple, bytes] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple) -> bytes | None:
+        """Return the encoded image stored under key, or None if it is not cached."""
+        data = self.images.get(key)
+        if data is None:
+            self.misses += 1
+            return None
+        self.images.move_to_end(key)
+        self.hits += 1
+        return data
+
+    def put(self, key: tuple, data: bytes):
+        """Store an encoded image under key, evicting the least recently used images if the cache is full."""
+        self.images[key] = data
+        self.images.move_to_end(key)
+        self.resize(self.maxsize)
+
+    def resize(self, maxsize: int):
+        """Change the number of images the cache may hold; a maxsize of 0 disables caching."""
+        self.maxsize = maxsize
+        while len(self.images) > self.maxsize:
+            self.images.popitem(last=False)
+
+    def clear(self):
+        self.images.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict:
+        """Return counters for sizing the cache."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self.images),
+            "maxsize": self.maxsize,
+            "bytes": sum(len(data) for data in self.images.values()),
+        }
+
+# encoded images of recently rendered positions, keyed by (board_fen, lastmove, mirror, size, format, quality)
+board_image_cache = BoardImageCache()
+
+_pieces: dict = None
+
+def get_pieces() -> dict:
+    """Return the piece images from generate_piece_images, loading the sprite sheet the first time they are needed rather than at import."""
+    global _pieces
+    if _pieces is None:
+        _pieces = generate_piece_images()
+    return _pieces
 
 # asd = {63: Piece.from_symbol('r'), 62: Piece.from_symbol('n'), 61: Piece.from_symbol('b'), 60: Piece.from_symbol('k'), 59: Piece.from_symbol('q'), 58: Piece.from_symbol('b'), 57: Piece.from_symbol('n'), 56: Piece.from_symbol('r'), 55: Piece.from_symbol('p'), 54: Piece.from_symbol('p'), 53: Piece.from_symbol('p'), 51: Piece.from_symbol('p'), 50: Piece.from_symbol('p'), 49: Piece.from_symbol('p'), 48: Piece.from_symbol('p'), 36: Piece.from_symbol('p'), 28: Piece.from_symbol('P'), 15: Piece.from_symbol('P'), 14: Piece.from_symbol('P'), 13: Piece.from_symbol('P'), 11: Piece.from_symbol('P'), 10: Piece.from_symbol('P'), 9: Piece.from_symbol('P'), 8: Piece.from_symbol('P'), 7: Piece.from_symbol('R'), 6: Piece.from_symbol('N'), 5: Piece.from_symbol('B'), 4: Piece.from_symbol('K'), 3: Piece.from_symbol('Q'), 2: Piece.from_symbol('B'), 1: Piece.from_symbol('N'), 0: Piece.from_symbol('R')}
 
-# ChessBoardImage(pieces, asd, (52, 36), False).img.show()
\ No newline at end of file
+# ChessBoardImage(get_pieces(), asd, (52, 36), False).img.show()
\ No newline at end of file
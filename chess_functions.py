@@ -4,8 +4,15 @@ import chess
 import chess.pgn
 import io
 from board_image import *
+from replay import render_replay
 import sqlite3
 import re
+import asyncio
+import functools
+import difflib
+import sys
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 
 # map chess pieces to their aliases
 piece_aliases = {
@@ -17,6 +24,41 @@ piece_aliases = {
     chess.PAWN: ["pawn", "a", "b", "c", "d", "e", "f", "g", "h"]
 }
 
+# executor that get_embed_async renders boards on; None uses the event loop's default thread pool
+render_executor: Executor | None = None
+
+def configure_render_executor(workers: int | None = None, processes: bool = False) -> Executor:
+    """Replace the executor boards are rendered on with a new pool of workers; processes renders across cores without contending for the GIL."""
+    global render_executor
+    old_executor = render_executor
+    render_executor = ProcessPoolExecutor(max_workers=workers) if processes else ThreadPoolExecutor(max_workers=workers, thread_name_prefix="board-render")
+    if old_executor:
+        old_executor.shutdown(wait=False)
+    return render_executor
+
+# totals over every board upload made by update_message, for tuning render settings
+upload_stats = {"uploads": 0, "bytes": 0, "edit_seconds": 0.0}
+
+# on_end callbacks still running, kept so they aren't garbage collected and their errors get reported
+end_tasks: set[asyncio.Task] = set()
+
+def end_task_done(task: asyncio.Task):
+    end_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Game end callback failed: {task.exception()!r}")
+
+# lookup tables built once from the names above, so resolving a word is a single dict or set lookup instead of a scan
+piece_alias_types = {alias: piece for piece, aliases in piece_aliases.items() for alias in aliases}
+square_indices = {name: square for square, name in enumerate(chess.SQUARE_NAMES)}
+file_indices = {name: file for file, name in enumerate(chess.FILE_NAMES)}
+castling_words = frozenset(("castle", "castles", "longcastle", "longcastles", "shortcastle", "shortcastles"))
+long_castling_words = frozenset(("longcastle", "longcastles", "long", "queen", "queenside"))
+en_passant_words = frozenset(("en-passant", "ep", "e.p.", "passant", "pasant"))
+promotion_words = frozenset(("promote", "promotes"))
+promotion_piece_types = frozenset((chess.KNIGHT, chess.BISHOP, chess.ROOK, chess.QUEEN))
+# words in a verbose move are separated by spaces, hyphens, and underscores
+move_word_pattern = re.compile(' |-|_')
+
 class ChessPlayer:
     def __init__(self, user: discord.User, elo: int = 1500, wins: int = 0, loss: int = 0, draw: int = 0, bot: bool = False):
         self.user = user
@@ -61,19 +103,261 @@ class ChessPlayer:
         cur.close()
         conn.close()
 
+# number words speech recognition spells out in square names, eg. "knight to f three"
+number_words = {"one": "1", "two": "2", "three": "3", "four": "4", "five": "5", "six": "6", "seven": "7", "eight": "8"}
+# words close misrecognitions are snapped to; filler words are included so they aren't snapped to something else
+speech_vocabulary = sorted(set(piece_alias_types) | set(square_indices) | castling_words | long_castling_words | en_passant_words | promotion_words
+                           | {"to", "takes", "take", "captures", "capture", "on", "side", "kingside", "short", "the", "and", "square"})
+
+@functools.lru_cache(maxsize=4096)
+def closest_speech_word(word: str) -> tuple[str, float]:
+    """Return the word of speech_vocabulary closest to word and their similarity, or word itself and 1.0 if none is close."""
+    match = difflib.get_close_matches(word, speech_vocabulary, n=1, cutoff=0.75)
+    if not match:
+        return word, 1.0
+    return match[0], difflib.SequenceMatcher(None, word, match[0]).ratio()
+
+def correct_transcript(transcript: str) -> tuple[str, float]:
+    """Snap each word of a speech transcript to the closest word a move can be made of, joining split square names
+    ("f 3", "f three"). Returns the corrected text and how similar it is to the original, from 0 to 1."""
+    words = []
+    similarity = 1.0
+    for word in move_word_pattern.split(transcript.lower()):
+        word = number_words.get(word, word)
+        if word.isdigit() and len(word) == 1 and words and words[-1] in file_indices:
+            words[-1] += word
+        elif word in speech_vocabulary or not word:
+            words.append(word)
+        else:
+            word, word_similarity = closest_speech_word(word)
+            similarity *= word_similarity
+            words.append(word)
+    return " ".join(word for word in words if word), similarity
+
+def san_key(san: str) -> str:
+    """Normalise a SAN string so the ways people write the same move (Nxf3+, Nf3, e8=Q, e8Q) share a key."""
+    return san.rstrip("+#!?").replace("x", "").replace("=", "").replace("0", "O")
+
+def phrase_key(move: str) -> tuple | None:
+    """Normalise a move written in words the way resolve_verbose reads it: aliases become piece types and filler words
+    are dropped, so every phrasing of a move ("horse to f3", "knight f3", "night-f3") shares a key. Returns None if the
+    words can't describe a move."""
+    move_arr = move_word_pattern.split(move.lower())
+    words = set(move_arr)
+
+    if not words.isdisjoint(castling_words):
+        return ("castle", not words.isdisjoint(long_castling_words))
+    if not words.isdisjoint(en_passant_words):
+        return ("ep", frozenset(file_indices[word] for word in words if word in file_indices))
+
+    # first word names the piece and the last word the square
+    piece = piece_alias_types.get(move_arr[0])
+    move_to = square_indices.get(move_arr[-1])
+    if piece is None or move_to is None:
+        return None
+    files = frozenset(file_indices[word] for word in move_arr[:-1] if word in file_indices)
+    promotion = None
+    if piece == chess.PAWN and not words.isdisjoint(promotion_words):
+        named = [piece_alias_types[word] for word in move_arr[1:] if piece_alias_types.get(word) in promotion_piece_types]
+        promotion = max(named) if named else chess.QUEEN
+    return (piece, files, promotion, move_to)
+
+class LegalMoveIndex:
+    """Every legal move of one position, indexed each way the move parsers look moves up, so parsing any number of
+    attempts against a position costs one move generation."""
+    def __init__(self, board: chess.Board):
+        self.board = board
+        # the position this index describes; DiscordChessGame.move_index rebuilds the index once this changes
+        self.key = (id(board), len(board.move_stack), board.move_stack[-1] if board.move_stack else None)
+        self.moves = list(board.legal_moves)
+        self.sans: dict[chess.Move, str] = {}
+        self.by_san: dict[str, chess.Move] = {}
+        self.by_uci: dict[str, chess.Move] = {}
+        self.by_piece_destination: dict[tuple, list[chess.Move]] = {}
+        self.by_file_destination: dict[tuple, list[chess.Move]] = {}
+        self.en_passant: list[chess.Move] = []
+
+        for move in self.moves:
+            san = board.san(move)
+            self.sans[move] = san
+            self.by_san[san_key(san)] = move
+            self.by_uci[move.uci()] = move
+            self.by_piece_destination.setdefault((board.piece_type_at(move.from_square), move.to_square), []).append(move)
+            self.by_file_destination.setdefault((chess.square_file(move.from_square), move.to_square), []).append(move)
+            if board.is_en_passant(move):
+                self.en_passant.append(move)
+
+    @functools.cached_property
+    def phrases(self) -> dict[tuple, list[chess.Move]]:
+        """phrase_key of every way resolve_verbose accepts a legal move -> the legal moves it names; keys naming more
+        than one move are ambiguous. Built the first time words are parsed in this position."""
+        phrases = {}
+        for move in self.moves:
+            if self.board.is_castling(move):
+                keys = [("castle", self.board.is_queenside_castling(move))]
+            else:
+                piece = self.board.piece_type_at(move.from_square)
+                from_file = frozenset((chess.square_file(move.from_square),))
+                # with or without the file the piece stands on, eg. "rook to f4" and "rook h to f4"
+                keys = [(piece, frozenset(), move.promotion, move.to_square), (piece, from_file, move.promotion, move.to_square)]
+                if move in self.en_passant:
+                    keys += [("ep", frozenset()), ("ep", from_file)]
+            for key in keys:
+                phrases.setdefault(key, []).append(move)
+        return phrases
+
+    def parse_phrase(self, move: str) -> chess.Move | None:
+        """Return the legal move a move written in words names, or None if it doesn't name one.
+        Raises AmbiguousMoveError if it could be several."""
+        moves = self.phrases.get(phrase_key(move))
+        if not moves:
+            return None
+        if len(moves) > 1:
+            raise chess.AmbiguousMoveError(f'"{move}" could be any of {", ".join(self.sans[m] for m in moves)}.')
+        return moves[0]
+
+    def match(self, move: str, spoken: bool = False) -> list[chess.Move]:
+        """Return every legal move that move could name in SAN, UCI or words, without raising; more than one means it's ambiguous."""
+        san = uci = move
+        if spoken:
+            # piece names must be caps for SAN, everything else lowercase
+            uci = move.lower()
+            san = uci.title() if len(uci) > 2 else uci
+        legal_move = self.parse_san(san) or self.parse_uci(uci)
+        if legal_move:
+            return [legal_move]
+        return self.phrases.get(phrase_key(move), [])
+
+    def parse_san(self, san: str) -> chess.Move | None:
+        """Return the legal move san names, or None if it doesn't name one."""
+        move = self.by_san.get(san_key(san))
+        if move is None:
+            # spellings the key doesn't cover, like fully disambiguated moves (Ng1f3), are left to python-chess
+            try:
+                move = self.board.parse_san(san)
+            except ValueError:
+                return None
+        return move
+
+    def parse_uci(self, uci: str) -> chess.Move | None:
+        """Return the legal move uci names, or None if it doesn't name one."""
+        move = self.by_uci.get(uci)
+        if move is None:
+            # eg. castling written as the king taking its rook
+            try:
+                move = self.board.parse_uci(uci)
+            except ValueError:
+                return None
+            # parse_uci lets the null move through without a legality check
+            if move not in self.sans:
+                return None
+        return move
+
+class MoveRecord:
+    """The SAN, formatted move list and PGN of a game, appended to as moves are made instead of replayed from the start
+    for every embed."""
+    def __init__(self, board: chess.Board):
+        self.source = board
+        # a copy of the game, up to the last recorded move, to write SAN from
+        self.board = board.root()
+        self.sans: list[str] = []
+        # "1. e4 e5 " for every complete pair of moves
+        self.lines: list[str] = []
+        self.pgn = chess.pgn.Game.from_board(self.board)
+        self.pgn_node: chess.pgn.GameNode = self.pgn
+
+    def append(self, move: chess.Move, san: str = None):
+        """Record the next move; san saves working it out again if it's already known."""
+        san = san or self.board.san(move)
+        self.board.push(move)
+        self.sans.append(san)
+        if len(self.sans) % 2 == 0:
+            self.lines.append(f"{len(self.lines) + 1}. {self.sans[-2]} {self.sans[-1]} ")
+        self.pgn_node = self.pgn_node.add_main_variation(move)
+
+    def sync(self, board: chess.Board):
+        """Record any moves made on board without going through append, starting over if board isn't the game recorded
+        so far, eg. a move was taken back or the board was replaced."""
+        recorded = len(self.sans)
+        if board is not self.source or recorded > len(board.move_stack) or (recorded and board.move_stack[recorded - 1] != self.board.move_stack[-1]):
+            self.__init__(board)
+            recorded = 0
+        for move in board.move_stack[recorded:]:
+            self.append(move)
+
+    def text(self, result: str = None, nl: bool = True, limit: int = None) -> str:
+        """Return the moves formatted for the embed, followed by result if given. If limit is set, only the latest
+        moves that fit in limit characters are shown, after a "..." line."""
+        # an unpaired last move and the result are formatted like another pair of moves
+        tail = self.sans[2*len(self.lines):] + ([result] if result else [])
+        if len(tail) == 2:
+            tail_text = f"{len(self.lines) + 1}. {tail[0]} {tail[1]} " + ("\n" if nl else "")
+        elif tail:
+            tail_text = f"{len(self.lines) + 1}. {tail[0]}"
+        else:
+            tail_text = ""
+        if not self.lines and not tail_text:
+            return "1. _"
+
+        end = "\n" if nl else ""
+        if limit is None:
+            return end.join(self.lines) + end + tail_text if self.lines else tail_text
+
+        # walk back from the latest move until the window is full
+        window = [tail_text]
+        length = len(tail_text)
+        for i in range(len(self.lines) - 1, -1, -1):
+            length += len(self.lines[i]) + len(end)
+            if length > limit - len("...\n"):
+                window.append("..." + end)
+                break
+            window.append(self.lines[i] + end)
+        return "".join(reversed(window))
+
 class DiscordChessGame:
-    def __init__(self, channel, white: ChessPlayer, black: ChessPlayer):
+    # repaint only the squares that changed since the last render instead of drawing the whole board every move
+    incremental_render = True
+    # class that draws whole boards; numpy_board_image.NumpyChessBoardImage draws identical images with numpy
+    board_image_class = ChessBoardImage
+    # how many times the best scoring speech move must outscore the next before it's played without asking
+    speech_margin = 1.5
+    # longest move list shown in the embed; discord allows 1024 characters per field, less the code block around it
+    moves_field_limit = 1024 - len("``````")
+
+    def __init__(self, channel, white: ChessPlayer, black: ChessPlayer, guild_id: int = None):
         self.game = chess.Board()
         self.channel: discord.TextChannel = channel
+        self.guild_id = guild_id
         self.white = white
         self.black = black
-        self.ctx: discord.ApplicationContext
+        # the game's message, set once it has been sent; until then the client doesn't route moves to the game
+        self.ctx: discord.ApplicationContext = None
         self.outcome = None
+        # coroutine function called with this game once, the first time update_message shows it finished
+        self.on_end = None
+        # time.monotonic() of the last update, used to evict idle games
+        self.last_active = time.monotonic()
+        # returns the (size, format, quality) to render this game's board with; the client points this at guild settings
+        self.render_settings = lambda: (800, "jpeg", 75)
+        self.renderer = IncrementalBoardRenderer(get_pieces(), image_class=self.board_image_class)
+        self._move_index: LegalMoveIndex | None = None
+        self.record = MoveRecord(self.game)
+        # (ply, score dict) of the engine's last evaluation of this game, recorded when the CPU replies
+        self.evaluation: tuple[int, dict] | None = None
+
+    @property
+    def move_index(self) -> LegalMoveIndex:
+        """The LegalMoveIndex of the current position, built the first time it's needed after each move."""
+        board = self.game
+        if self._move_index is None or self._move_index.key != (id(board), len(board.move_stack), board.move_stack[-1] if board.move_stack else None):
+            self._move_index = LegalMoveIndex(board)
+        return self._move_index
 
     def __repr__(self):
         return f"< Chess Game between {self.white.user.name} and {self.black.user.name} >"
 
-    def get_board_image(self, size=1800):
+    def get_board_image_args(self, size=800, format="jpeg", quality=75) -> tuple:
+        """Return the render_board arguments for the current position, which also key it in board_image_cache."""
         lastmove = ()
 
         if self.game.move_stack:
@@ -82,47 +366,83 @@ class DiscordChessGame:
 
         mirror = not self.game.turn
 
-        board_img = ChessBoardImage(pieces, self.game.piece_map(), lastmove, mirror)
-        img_io = io.BytesIO()
-        board_img.img.save(img_io, "jpeg")
-        img_io.seek(0)
-
-        return img_io
-
-    def get_moves(self, nl = True):
-        """Returns a string of moves in standard algebraic notation"""
-        string_to_return = "1. _"
-        line_ctr = 1
-        moves = []
-        # create a temporary game
-        tempgame = chess.Board()
-        # push each move to the temp game, getting the san of each move
-        for move in self.game.move_stack:
-            san = tempgame.san_and_push(move)
-            moves.append(san)
-
-        if self.outcome:
-            moves.append(self.outcome.result())
+        # only the piece placement is drawn, so positions reached by different move orders share an image
+        return (self.game.board_fen(), lastmove, mirror, size, format, quality)
+
+    def get_board_image(self, size=800, format="jpeg", quality=75):
+        key = self.get_board_image_args(size, format, quality)
+        data = board_image_cache.get(key)
+        if data is None:
+            data = render_board(*key, renderer=self.renderer if self.incremental_render else None, image_class=self.board_image_class)
+            board_image_cache.put(key, data)
+
+        return io.BytesIO(data)
+
+    async def get_board_image_async(self, size=800, format="jpeg", quality=75):
+        """Same as get_board_image, but renders on render_executor so the event loop keeps running while the board is drawn."""
+        key = self.get_board_image_args(size, format, quality)
+        data = board_image_cache.get(key)
+        if data is None:
+            # the renderer lives in this process, so it can't be used from a process pool
+            renderer = self.renderer if self.incremental_render and not isinstance(render_executor, ProcessPoolExecutor) else None
+            data = await asyncio.get_running_loop().run_in_executor(render_executor, functools.partial(render_board, *key, renderer=renderer, image_class=self.board_image_class))
+            board_image_cache.put(key, data)
+
+        return io.BytesIO(data)
+
+    async def get_replay_async(self, format="gif", size=400):
+        """Return an animated replay of the game so far as a gif or apng, rendered on render_executor"""
+        render = functools.partial(render_replay, list(self.game.move_stack), format, size, False, self.game.root().fen())
+        return io.BytesIO(await asyncio.get_running_loop().run_in_executor(render_executor, render))
+
+    def memory_usage(self) -> int:
+        """Return a rough estimate of the bytes this game holds: its board and move history, plus any frames kept for incremental rendering."""
+        size = sys.getsizeof(self.game) + sys.getsizeof(self.game.move_stack) + sum(sys.getsizeof(move) for move in self.game.move_stack)
+        # the recorded SAN and lines, a copy of the board, and one PGN node per move
+        size += sum(sys.getsizeof(san) for san in self.record.sans) + sum(sys.getsizeof(line) for line in self.record.lines)
+        size += sys.getsizeof(self.record.board) + sys.getsizeof(self.record.board.move_stack) + len(self.record.sans) * sys.getsizeof(self.record.pgn)
+        for frame, _, _ in self.renderer.frames.values():
+            size += frame.width * frame.height * len(frame.getbands())
+        return size
+
+    def get_moves(self, nl = True, limit: int = None):
+        """Returns a string of moves in standard algebraic notation; see MoveRecord.text for limit"""
+        self.record.sync(self.game)
+        return self.record.text(self.outcome.result() if self.outcome else None, nl, limit)
+
+    def get_pgn(self) -> str:
+        """Return the game so far as PGN"""
+        self.record.sync(self.game)
+        pgn = self.record.pgn
+        pgn.headers["White"] = str(self.white.user)
+        pgn.headers["Black"] = str(self.black.user)
+        pgn.headers["Result"] = self.outcome.result() if self.outcome else "*"
+        return str(pgn)
+
+    def push(self, move: chess.Move):
+        """Make a legal move, recording it in the move list and PGN as it's made"""
+        self.record.sync(self.game)
+        self.record.append(move, self.move_index.sans.get(move))
+        self.game.push(move)
 
-        # format moves into lines for the embed
-        if moves:
-            string_to_return = ""
-            for i,j in zip(moves[0::2], moves[1::2]):
-                str = f"{line_ctr}. {i} {j} "
-                str += "\n" if nl else ""
-                string_to_return += str
-                line_ctr += 1
-            if len(moves) % 2 != 0:
-                string_to_return += f"{line_ctr}. {moves[-1]}"
-
-        return string_to_return
-    
     def get_embed(self):
         """Return a discord embed object representing the chess game"""
+        size, format, quality = self.render_settings()
+        return self.make_embed(self.get_board_image(size, format, quality), format)
+
+    async def get_embed_async(self):
+        """Return a discord embed object representing the chess game, rendering the board off the event loop"""
+        size, format, quality = self.render_settings()
+        return self.make_embed(await self.get_board_image_async(size, format, quality), format)
+
+    def make_embed(self, board_image: io.BytesIO, format="jpeg"):
+        """Build the embed and attachment dict for get_embed from an already encoded board image"""
+        # name the attachment after its real format so clients treat it correctly
+        filename = f"board.{IMAGE_FORMATS[format]}"
         players = f"{self.white.user} ({self.white.elo}) vs. {self.black.user} ({self.black.elo})"
 
-        # formatted move list in san
-        moves = self.get_moves()
+        # formatted move list in san; long games only show their latest moves, so the field stays under discord's limit
+        moves = self.get_moves(limit=self.moves_field_limit)
 
         embed = discord.Embed()
         embed.set_author(name=f"Chess Game - {players}")
@@ -132,13 +452,13 @@ class DiscordChessGame:
                 embed.set_author(name=f"Chess Game - {players} - DRAW")
             else:
                 embed.set_author(name=f"Chess Game - {players} - {self.get_winner().user.display_name} WINS!")
-        embed.set_image(url="attachment://board.png")
+        embed.set_image(url=f"attachment://{filename}")
         embed.add_field(name="Moves", value=f"```{moves}```", inline=True)
         embed.set_footer(text=f"Game started \non {datetime.now().strftime('%B %d, %Y')}")
 
         dict = {
             "embed": embed,
-            "file": discord.File(self.get_board_image(), "board.png")
+            "file": discord.File(board_image, filename)
         }
 
         return dict
@@ -227,237 +547,186 @@ class DiscordChessGame:
             return False
 
     async def update_message(self):
-        e = self.get_embed()
+        self.last_active = time.monotonic()
+        e = await self.get_embed_async()
+        upload_bytes = e['file'].fp.getbuffer().nbytes
+        start = time.perf_counter()
         if self.outcome:
             # if game is over, get rid of the buttons
             await self.ctx.edit(file = e['file'], embed = e['embed'], view = None)
+            # the board won't change again, so the frames kept for incremental rendering are dead weight
+            self.renderer.frames.clear()
         else:
             await self.ctx.edit(file = e['file'], embed = e['embed'])
+        upload_stats["uploads"] += 1
+        upload_stats["bytes"] += upload_bytes
+        upload_stats["edit_seconds"] += time.perf_counter() - start
+
+        if self.outcome and self.on_end:
+            on_end, self.on_end = self.on_end, None
+            # in the background, so archiving doesn't hold up whoever made the last move or answered the draw offer
+            task = asyncio.create_task(on_end(self))
+            end_tasks.add(task)
+            task.add_done_callback(end_task_done)
     
-    async def try_speechrec_move(self, possibilities: list):
-        """Parse through a list of possibilities for a chess move"""
-        for possibility in possibilities['alternative']:
-            # TODO: fix error
-            # TODO: gradually remove first word from string to test, in case we picked something up first
-            possibility_text = possibility['transcript']
-            print(possibility_text)
-            move: str = None
-            try:
-                # attempt format for SAN (piece name must be caps, all other lowercase)
-                possibility_text = possibility_text.lower()
-                if len(possibility_text) > 2:
-                    possibility_text = possibility_text.title()
-                self.game.parse_san(possibility_text)
-            except:
-                try:
-                    # attempt format for UCI
-                    possibility_text = possibility_text.lower()
-                    uci = self.game.parse_uci(possibility_text)
-                except:
-                    try:
-                        move = self.resolve_verbose(possibility_text)
-                    except Exception as e:
-                        #print(e)
-                        pass
-                else:
-                    move = self.game.san(uci)
-            else:
-                move = possibility_text
-            if move:
-                # print(move)
-                # try move
-                res = self.try_move(move)
-                if res:
-                    # if move was successful
-                    # attempt to end game
-                    self.end_game()
-                    # update message
-                    await self.update_message()
-                return res
+    async def try_speechrec_move(self, possibilities: dict):
+        """Push the move the speech recognition alternatives most likely name. Returns True if a move was made, a short
+        list of candidate moves in SAN if no move was clearly the best, and None if none of them named a legal move."""
+        choice = self.choose_speech_move(possibilities)
+        if not isinstance(choice, chess.Move):
+            return choice
+
+        self.push(choice)
+        # attempt to end game
+        self.end_game()
+        # update message
+        await self.update_message()
+        return True
+
+    def choose_speech_move(self, possibilities: dict) -> chess.Move | list[str] | None:
+        """Return the move a recognize_google(show_all=True) result names, a short list of candidates in SAN if no move
+        was clearly the best, or None if no alternative named a legal move."""
+        if not isinstance(possibilities, dict):
+            # nothing was heard, or recognition failed
+            return None
+        ranked = self.rank_speech_alternatives(possibilities)
+        if not ranked:
+            return None
+        if len(ranked) > 1 and ranked[0][1] < ranked[1][1] * self.speech_margin:
+            return [self.move_index.sans[move] for move, _ in ranked]
+        return ranked[0][0]
+
+    def rank_speech_alternatives(self, possibilities: dict, limit: int = 5) -> list[tuple[chess.Move, float]]:
+        """Score every legal move named by any alternative of a recognize_google(show_all=True) result and return the best
+        (move, score) pairs, highest first. An alternative's score is its confidence times how little its words had to be
+        corrected; alternatives that agree on a move reinforce each other."""
+        index = self.move_index
+        alternatives = possibilities.get('alternative', ())
+        # google only gives a confidence for the first alternative; assume the rest trail off from it
+        top_confidence = alternatives[0].get('confidence', 1.0) if alternatives else 1.0
+        scores: dict[chess.Move, float] = {}
+
+        for rank, possibility in enumerate(alternatives):
+            transcript = possibility['transcript']
+            confidence = possibility.get('confidence', top_confidence * 0.9 ** rank)
+            moves, similarity = index.match(transcript, spoken=True), 1.0
+            if not moves:
+                corrected, similarity = correct_transcript(transcript)
+                moves = index.match(corrected, spoken=True)
+            for move in moves:
+                # an ambiguous alternative splits its score between the moves it could be
+                score = confidence * similarity / len(moves)
+                # combined like independent pieces of evidence, so it stays between 0 and 1
+                scores[move] = 1 - (1 - scores.get(move, 0.0)) * (1 - score)
+
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+    def parse_move(self, move: str, spoken: bool = False) -> chess.Move:
+        """Resolve a move written in SAN, UCI or words against the move index of the current position.
+        spoken fixes up capitalisation for text from speech recognition. Raises a ValueError if it isn't a legal move."""
+        # First try algebraic notation, then UCI notation, then every phrasing of the legal moves
+        moves = self.move_index.match(move, spoken)
+        if len(moves) == 1:
+            return moves[0]
+        if moves:
+            raise chess.AmbiguousMoveError(f'"{move}" could be any of {", ".join(self.move_index.sans[m] for m in moves)}.')
+        # nothing matched; resolve_verbose_move explains why
+        return self.resolve_verbose_move(move)
 
     def try_move(self, move: str):
         """Try resolving a move from a string (likely discord message content) and push it. Returns True if successful, False if not."""
-        # First try algebraic notation
         try:
-            self.game.push_san(move)
-        except:
-            # Try UCI notation
-            try:
-                self.game.push_uci(move)
-            except:
-                # if algebraic and universal chess notation both failed, try resolving using our own methods
-                try:
-                    san = self.resolve_verbose(move)
-                    #print(san)
-                    self.game.push_san(san)
-                except Exception as e:
-                    print(e)
-                else:
-                    return True
-            else:
-                # if UCI worked, return True
-                return True
-        else:
-            # if it worked, return True
-            return True
+            legal_move = self.parse_move(move)
+        except Exception as e:
+            print(e)
+            return False
+        self.push(legal_move)
+        return True
+
+    def resolve_verbose(self, move: str) -> str:
+        """Resolve a move written in words, eg. "knight to f3", and return it in SAN."""
+        index = self.move_index
+        return index.sans[index.parse_phrase(move) or self.resolve_verbose_move(move)]
 
-    def resolve_verbose(self, move: str):
+    def resolve_verbose_move(self, move: str) -> chess.Move:
+        index = self.move_index
         # split input string by spaces, hyphens, and underscores
-        move_arr = re.split(' |-|_', move.lower())
+        move_arr = move_word_pattern.split(move.lower())
+        words = set(move_arr)
 
         # check castling and en-passant
-        for word in move_arr:
-            if word in ("castle", "castles", "longcastle", "longcastles", "shortcastle", "shortcastles"):
-                # if we are trying to castle
-
-                if not self.game.has_castling_rights(self.game.turn):
-                    # make no move if player doesn't have castling rights
-                    raise chess.IllegalMoveError(f'{"White" if self.game.turn else "Black"} does not have castling rights.')
-                
-                try:
-                    # if there are no castling moves, raise IllegalMoveError
-                    self.game.generate_castling_moves().__next__()
-                except:
-                    raise chess.IllegalMoveError('There are no legal castling moves in the current position.')
-                
-                if "longcastle" in move_arr or "longcastles" in move_arr or "long" in move_arr or "queen" in move_arr or "queenside" in move_arr:
-                    # if "long", "queen", or "queenside" is designated in the move_arr, do a long castle
-                    #print("long castle")
-                    try:
-                        self.game.parse_san("O-O-O")
-                    except:
-                        raise chess.IllegalMoveError('Queen-side castling is not legal in the current position.')
-                    else:
-                        return "O-O-O"
-                else:
-                    #print("short castle")
-                    try:
-                        self.game.parse_san("O-O")
-                    except:
-                        raise chess.IllegalMoveError('King-side castling is not legal in the current position.')
-                    else:
-                        return "O-O"
-            elif word in ("en-passant", "ep", "e.p.", "passant", "pasant"):
-                # if we're trying en passant
-                if not self.game.has_legal_en_passant():
-                    raise chess.IllegalMoveError(f'There is no legal en-passant in the current position.')
-                
-                legal_moves: list[chess.Move] = []
-                for move in self.game.generate_legal_ep():
-                    legal_moves.append(move)
-
-                move_to_play: chess.Move = None
-                for move in legal_moves:
-                    if not move_to_play:
-                        move_to_play = move
-                    else:
-                        # if there are multiple legal en-passants
-                        move_to_play = None
-                        for word in move_arr:
-                            # go through each word in the message
-                            if word in chess.FILE_NAMES:
-                                # if the word is a file, determine which file it is
-                                for i, file in enumerate(chess.FILE_NAMES):
-                                    # track down the file the user said
-                                    if file == word:
-                                        for m in legal_moves:
-                                            # if this move's piece file is i, just do the thingy
-                                            if chess.square_file(m.from_square) == i:
-                                                move_to_play = m
-                                                break
-                    
-                # if there is no en-passant move defined
-                if not move_to_play:
-                    raise chess.AmbiguousMoveError(f'There are multiple or no legal en-passants in the current position. Clarify by typing which piece is to play en-passant.')
+        if not words.isdisjoint(castling_words):
+            # if we are trying to castle
+
+            if not self.game.has_castling_rights(self.game.turn):
+                # make no move if player doesn't have castling rights
+                raise chess.IllegalMoveError(f'{"White" if self.game.turn else "Black"} does not have castling rights.')
+
+            if "O-O" not in index.by_san and "O-O-O" not in index.by_san:
+                # if there are no castling moves, raise IllegalMoveError
+                raise chess.IllegalMoveError('There are no legal castling moves in the current position.')
+
+            if not words.isdisjoint(long_castling_words):
+                # if "long", "queen", or "queenside" is designated in the move_arr, do a long castle
+                if "O-O-O" not in index.by_san:
+                    raise chess.IllegalMoveError('Queen-side castling is not legal in the current position.')
+                return index.by_san["O-O-O"]
+            else:
+                if "O-O" not in index.by_san:
+                    raise chess.IllegalMoveError('King-side castling is not legal in the current position.')
+                return index.by_san["O-O"]
+
+        if not words.isdisjoint(en_passant_words):
+            # if we're trying en passant
+            legal_moves = index.en_passant
+            if not legal_moves:
+                raise chess.IllegalMoveError(f'There is no legal en-passant in the current position.')
+
+            if len(legal_moves) > 1:
+                # if there are multiple legal en-passants, narrow them down by the file the user said
+                files = {file_indices[word] for word in words if word in file_indices}
+                legal_moves = [m for m in legal_moves if chess.square_file(m.from_square) in files]
 
-                return self.game.san(move_to_play)
+            # if there is no en-passant move defined
+            if len(legal_moves) != 1:
+                raise chess.AmbiguousMoveError(f'There are multiple or no legal en-passants in the current position. Clarify by typing which piece is to play en-passant.')
+
+            return legal_moves[0]
 
         # move_to = square id of last "word" in move_arr, must be a square name
-        move_to = None
-        if move_arr[-1] not in chess.SQUARE_NAMES:
+        move_to = square_indices.get(move_arr[-1])
+        if move_to is None:
             raise chess.IllegalMoveError(f'{move_arr[-1]} is not a valid square.')
-        else:
-            # get the square index from the square name
-            for i, name in enumerate(chess.SQUARE_NAMES):
-                if move_arr[-1] == name:
-                    move_to = i
-        
-        # a set of squares on which pieces may be moved, populated by piece resolution below
-        candidates_to_move: chess.SquareSet = None
 
         # resolve the piece
-        for piece in piece_aliases:
-            # for each piece_alias
-            for alias in piece_aliases[piece]:
-                if move_arr[0] == alias:
-                    #  print(piece)
-                    # find all of the pieces that match the given piece on the given side
-                    candidates_to_move = self.game.pieces(piece, self.game.turn)
-
-                    # handle promotion case
-                    if "promote" in move_arr or "promotes" in move_arr:
-                        if piece == chess.PAWN:
-                            # only pawns can promote
-                            for square in candidates_to_move:
-                                if chess.square_rank(square) == 6:
-                                    # if it's on the 7th rank, it may be able to promote
-                                    for move in self.game.generate_legal_moves():
-                                        if move.to_square == move_to:
-                                            # if this is the correct move based on the move_to variable, determine what we're promoting to
-                                            promotion = chess.QUEEN # default to queen if otherwise undefined 
-                                            for piece in range(2, 6):
-                                                for alias in piece_aliases[piece]:
-                                                    if alias in move_arr[1:]:
-                                                        # we don't need the first piece of move_arr since that's the piece we want to move, find the other one
-                                                        promotion = piece
-                                            move_to_play = chess.Move(square, move_to, promotion)
-                                            return self.game.san(move_to_play)
-
-                    break
-
-        # raise error if we don't have any candidates to move (most likely invalid move supplied)
-        if not candidates_to_move:
+        piece = piece_alias_types.get(move_arr[0])
+
+        # raise error if we don't have any pieces of that type (most likely invalid move supplied)
+        if not piece or not self.game.pieces_mask(piece, self.game.turn):
             raise chess.InvalidMoveError(f'Could not resolve any {"White" if self.game.turn else "Black"} "{move_arr[0]}" pieces.')
-        
-        #print(candidates_to_move)
-
-        piece_to_move: chess.Square = None
-        # potentially narrow down the candidates to a specific one, if given a file (ie. Rook H to f4)
-        for word in move_arr:
-            for i, file in enumerate(chess.FILE_NAMES): 
-                if file == word:
-                    # if the word is the file
-                    # print(word)
-                    for square in candidates_to_move:
-                        # for each square object in candidates_to_move SquareSet
-                        if chess.square_file(square) == i:
-                            # if the file of the square is the integer value of the file, set that square to piece_to_move
-                            piece_to_move = square
-                            print(square)
-                            break
-
-        # print(piece_to_move)
-
-        # need to explicitly say "is not None" in case piece_to_move = 0 (which it can be for square a1)
-        if piece_to_move is not None:
-            # if piece_to_move is set from above, formulate move from the known piece's square and the known square to move to
-            move = chess.Move(piece_to_move, move_to)
-            if self.game.is_legal(move):
-                #print(game.board_fen())
-                return self.game.san(move)
-            else:
-                raise chess.IllegalMoveError(f'Could not move {move_arr[0]} from {chess.SQUARE_NAMES[piece_to_move]} to {chess.SQUARE_NAMES[move_to]}')
-        else:
-            #print("No specific piece!")
-            # if piece_to_move is *not* set, determine which piece(s) in candidates_to_move are able to legally make the move; if it's multiple, ask user to clarify.
-            move_to_play: chess.Move = None
-            for square in candidates_to_move:
-                temp_move = chess.Move(square, move_to)
-                #print(temp_move)
-                if self.game.is_legal(temp_move):
-                    if not move_to_play:
-                        move_to_play = temp_move
-                    else:
-                        raise chess.AmbiguousMoveError(f'There are multiple {move_arr[0]}s that can move to {chess.SQUARE_NAMES[move_to]}')
 
-            return self.game.san(move_to_play)
\ No newline at end of file
+        # the legal moves of that piece type to the square
+        legal_moves = index.by_piece_destination.get((piece, move_to), [])
+
+        # potentially narrow down the candidates to a specific one, if given a file (ie. Rook H to f4); for pawns the piece name is the file
+        files = {file_indices[word] for word in move_arr[:-1] if word in file_indices}
+        if files:
+            if not any(chess.square_file(square) in files for square in self.game.pieces(piece, self.game.turn)):
+                raise chess.IllegalMoveError(f'There are no {"White" if self.game.turn else "Black"} {move_arr[0]}s on the {"/".join(chess.FILE_NAMES[f] for f in sorted(files))} file.')
+            legal_moves = [m for file in sorted(files) for m in index.by_file_destination.get((file, move_to), ()) if m in legal_moves]
+
+        # handle promotion case; only pawns can promote
+        promotion = None
+        if piece == chess.PAWN and not words.isdisjoint(promotion_words):
+            # default to queen if otherwise undefined; we don't need the first word of move_arr since that's the pawn, find the other piece
+            named = [piece_alias_types[word] for word in move_arr[1:] if piece_alias_types.get(word) in promotion_piece_types]
+            promotion = max(named) if named else chess.QUEEN
+
+        # determine which of those moves match; if it's multiple, ask user to clarify.
+        legal_moves = [m for m in legal_moves if m.promotion == promotion]
+        if not legal_moves:
+            raise chess.IllegalMoveError(f'Could not move {move_arr[0]} to {chess.SQUARE_NAMES[move_to]}')
+        if len(legal_moves) > 1:
+            raise chess.AmbiguousMoveError(f'There are multiple {move_arr[0]}s that can move to {chess.SQUARE_NAMES[move_to]}')
+
+        return legal_moves[0]
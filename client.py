@@ -1,15 +1,34 @@
 import discord
 from discord.ext import tasks
 from discord.utils import get
-from chess_functions import DiscordChessGame, ChessPlayer
+from chess_functions import DiscordChessGame, ChessPlayer, configure_render_executor
+from board_image import board_image_cache, get_pieces, IMAGE_FORMATS
 from typing import List
-import stockfish
+import chess
+import chess.engine
+import functools
+import os
 import sqlite3
 import time
 
 import speech_recognition as sr
-from pydub import AudioSegment
 import io
+import asyncio
+from startup import LazyResource, startup_report, startup_timings
+from game_registry import GameRegistry, GameRegistryFull
+from engine_pool import EnginePool, SearchTelemetry, open_uci_engine, close_uci_engine, uci_engine_alive, strength_options
+from engine_cache import EngineResultCache, result_from_info, score_dict
+from opening_book import OpeningBook
+from voice_sink import UtteranceSink, VoiceStats
+
+# what a CPU search can fail with: the engine timing out or misbehaving, or its process failing to start (eg. a missing binary)
+ENGINE_ERRORS = (asyncio.TimeoutError, chess.engine.EngineError, OSError)
+
+def engine_failure_text(error: Exception) -> str:
+    """Return what to tell a player when the CPU's engine fails with error"""
+    if isinstance(error, OSError):
+        return "The CPU's chess engine couldn't be started"
+    return "The CPU couldn't think in time"
 
 class VocalChessView(discord.ui.View):
     def __init__(self):
@@ -20,22 +39,25 @@ class CPUGameView(VocalChessView):
     @discord.ui.button(label="Offer Draw", custom_id="drawoffer_cpu", style=discord.ButtonStyle.primary, emoji="🤝")
     async def draw_callback(self, button, interaction: discord.Interaction):
         game: DiscordChessGame = self.game
-        engine: stockfish.Stockfish = self.engine
+        # a search can take longer than discord waits for a response, so acknowledge the click first
+        await interaction.response.defer(ephemeral=True)
+        try:
+            evaluation = await self.client.evaluate(game)
+        except ENGINE_ERRORS as e:
+            print(f"Draw offer evaluation failed in {game}: {e!r}")
+            await interaction.followup.send(f"{engine_failure_text(e)}, so it couldn't consider your draw offer; try again.", ephemeral=True, delete_after=5)
+            return
         if game.black.bot:
             # if the evaluation is greater than 500 centipawns (white favor), accept draw
-            if engine.get_evaluation()['value'] > 500:
-                game.end_game(force_draw=True)
-                await interaction.response.send_message("Your draw offer was accepted.", ephemeral=True, delete_after=5)
-                await game.update_message()
-            else:
-                await interaction.response.send_message("Your draw offer was rejected.", ephemeral=True, delete_after=5)
+            accept = evaluation['value'] > 500
         else:
-            if engine.get_evaluation()['value'] < -500:
-                game.end_game(force_draw=True)
-                await interaction.response.send_message("Your draw offer was accepted.", ephemeral=True, delete_after=5)
-                await game.update_message()
-            else:
-                await interaction.response.send_message("Your draw offer was rejected.", ephemeral=True, delete_after=5)
+            accept = evaluation['value'] < -500
+        if accept:
+            game.end_game(force_draw=True)
+            await interaction.followup.send("Your draw offer was accepted.", ephemeral=True, delete_after=5)
+            await game.update_message()
+        else:
+            await interaction.followup.send("Your draw offer was rejected.", ephemeral=True, delete_after=5)
 
     @discord.ui.button(label="Forfeit", custom_id="forfeit_cpu", style=discord.ButtonStyle.secondary, emoji="🇫🇷")
     async def forfeit_callback(self, button, interaction: discord.Interaction):
@@ -74,7 +96,7 @@ class GameView(VocalChessView):
         client: VocalChessClient = self.client
         
         # in case it's in progress, stop it
-        client.check_voice.stop()
+        client.stop_listening()
 
         voice = interaction.user.voice
 
@@ -111,11 +133,18 @@ class GameOfferView(VocalChessView):
             black_player = ChessPlayer(self.interaction.user)
 
         channel = await self.interaction.guild.create_text_channel(name=f"{white_player.user.display_name} vs {black_player.user.display_name}", category=self.client.get_channel(self.client.guild_data[self.interaction.guild.id].category_id))
-        game = DiscordChessGame(channel = channel.id, white = white_player, black = black_player)
+        game = DiscordChessGame(channel = channel.id, white = white_player, black = black_player, guild_id = self.interaction.guild.id)
+        game.on_end = self.client.archive_game
 
-        e = game.get_embed()
+        # reserve the game's slot; it isn't played until its message is sent and ctx is set below
+        try:
+            self.client.track_game(game)
+        except GameRegistryFull as error:
+            await channel.delete()
+            await interaction.response.send_message(f"{error}", ephemeral=True, delete_after=10)
+            return
 
-        self.client.games.append(game)
+        e = await game.get_embed_async()
 
         view = GameView()
         view.client = self.client
@@ -133,63 +162,335 @@ class GameOfferView(VocalChessView):
 
 class GuildInfo:
     """Data structure for holding guild information."""
-    def __init__(self, archive: bool = False, archive_channel: int = 0, category_id: int = 0):
-        self.archive = archive
+    def __init__(self, archive: bool = False, archive_channel: int = 0, category_id: int = 0, render_size: int = 800, render_format: str = "jpeg", render_quality: int = 75):
+        self.archive = bool(archive)
         self.archive_channel = archive_channel
         self.category_id = category_id
+        # board images; smaller sizes and lossy formats upload faster and cost less bandwidth
+        self.render_size = render_size
+        self.render_format = render_format
+        self.render_quality = render_quality
+
+    def set(self, setting: str, value):
+        """Set a setting from user input, converting it to the setting's type. Raises ValueError if the value isn't valid for the setting."""
+        current = getattr(self, setting)
+        if isinstance(current, bool):
+            value = str(value).lower() in ("true", "yes", "on", "1")
+        elif isinstance(current, int):
+            value = int(value)
+        else:
+            value = str(value).lower()
+
+        if setting == "render_size" and not 200 <= value <= 1600:
+            raise ValueError("render_size must be between 200 and 1600 pixels.")
+        if setting == "render_format" and value not in IMAGE_FORMATS:
+            raise ValueError(f"render_format must be one of {', '.join(IMAGE_FORMATS)}.")
+        if setting == "render_quality" and not 1 <= value <= 100:
+            raise ValueError("render_quality must be between 1 and 100.")
+
+        setattr(self, setting, value)
         
     def update(self, guild_id: int):
         """Upsert this GuildInfo object into the database"""
         conn = sqlite3.connect("database.db")
         cur = conn.cursor()
         cur.execute(f"""
-            INSERT INTO guilds (id, archive, archive_channel, category_id) VALUES ({guild_id}, {self.archive}, {self.archive_channel}, {self.category_id})
-            ON CONFLICT(id) DO UPDATE SET archive = {self.archive}, archive_channel = {self.archive_channel}, category_id = {self.category_id}
-        """)
+            INSERT INTO guilds (id, archive, archive_channel, category_id, render_size, render_format, render_quality) VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET archive = excluded.archive, archive_channel = excluded.archive_channel, category_id = excluded.category_id,
+                render_size = excluded.render_size, render_format = excluded.render_format, render_quality = excluded.render_quality
+        """, (guild_id, self.archive, self.archive_channel, self.category_id, self.render_size, self.render_format, self.render_quality))
         conn.commit()
         cur.close()
         conn.close()
 
-class VocalChessClient(discord.Bot):
-    # initialize stockfish with depth of 18; only one instance for the whole bot
-    engine = stockfish.Stockfish(path="stockfish-windows-2022-x86-64-avx2.exe", depth=18)
+def load_guild_data() -> dict[GuildInfo]:
+    """Read every guild's settings from the database, creating the table if needed."""
+    conn = sqlite3.connect("database.db")
+    cur = conn.cursor()
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS guilds (id INT PRIMARY KEY, archive INT, archive_channel INT, category_id INT, render_size INT DEFAULT 800, render_format TEXT DEFAULT 'jpeg', render_quality INT DEFAULT 75)
+    """)
+    # add the render settings to databases created before they existed
+    columns = [column[1] for column in cur.execute("PRAGMA table_info(guilds)").fetchall()]
+    for column, definition in (("render_size", "INT DEFAULT 800"), ("render_format", "TEXT DEFAULT 'jpeg'"), ("render_quality", "INT DEFAULT 75")):
+        if column not in columns:
+            cur.execute(f"ALTER TABLE guilds ADD COLUMN {column} {definition}")
+    conn.commit()
+    cur.execute(f"""
+        SELECT id, archive, archive_channel, category_id, render_size, render_format, render_quality FROM guilds
+    """)
+    results = cur.fetchall()
+    cur.close()
+    conn.close()
+
+    guild_data = {}
+    for result in results:
+        guild_data[result[0]] = GuildInfo(*result[1:])
+    return guild_data
+
+class PonderState:
+    """The CPU's answers to the human's likeliest replies in one CPU game, searched while the human thinks"""
+    def __init__(self):
+        self.task: asyncio.Task = None
+        # position after a predicted reply, as epd -> future of the engine result for the CPU's answer
+        self.answers: dict[str, asyncio.Future] = {}
+        # the answer being searched right now
+        self.current: asyncio.Future = None
 
-    def __init__(self, *args, **kwargs):
+class VocalChessClient(discord.Bot):
+    def __init__(self, *args, image_cache_size: int = 256, render_workers: int | None = None, render_processes: bool = False, render_backend: str = "pil", warm_on_ready: bool = True,
+                 max_games: int = 500, finished_ttl: float = 15*60, idle_ttl: float = 24*60*60, on_game_evict = None, adaptive_render_threshold: int = 50,
+                 engine_processes: int | None = None, engine_path: str = "stockfish-windows-2022-x86-64-avx2.exe", engine_timeout: float = 5,
+                 search_budget: float = 2.0, engine_depth: int = 18,
+                 engine_cache_size: int = 10000, persist_engine_cache: bool = False, opening_book: str | None = None, ponder: bool = True, ponder_moves: int = 3, **kwargs):
         intents = discord.Intents.default()
         intents.message_content = True # required to use message.content in on_message
         super().__init__(intents=intents)
-        self.games: List[DiscordChessGame] = []
-        self.guild_data: dict[GuildInfo] = {}
+        self.games = GameRegistry(max_games, finished_ttl, idle_ttl, on_evict=on_game_evict)
+
+        # subsystems a shard may never use are created on first use, or in the background after on_ready if warm_on_ready
+        # stockfish processes shared by every CPU game, one search per process at a time; defaults to one per core, up to 4
+        self.engine_pool = EnginePool(functools.partial(open_uci_engine, engine_path), close_uci_engine, uci_engine_alive, size=engine_processes or min(4, os.cpu_count() or 1))
+        # stockfish searches deeper for stronger CPUs, up to engine_depth, but is told to answer within search_budget seconds;
+        # a search that still hasn't answered after engine_timeout seconds is cancelled
+        self.engine_depth = engine_depth
+        self.search_budget = search_budget
+        self.engine_timeout = max(engine_timeout, search_budget)
+        self.search_telemetry = SearchTelemetry(search_budget)
+        # engine results for positions seen before, optionally kept in the database across restarts
+        self.engine_cache = EngineResultCache(engine_cache_size, "database.db" if persist_engine_cache else None)
+        # optional polyglot book the CPU plays its opening moves from instead of searching
+        self.opening_book: OpeningBook | None = None
+        if opening_book:
+            if os.path.exists(opening_book):
+                self.opening_book = OpeningBook(opening_book)
+            else:
+                print(f"Opening book {opening_book} not found; the CPU will search every move")
+        # while a human thinks, search the CPU's answers to their ponder_moves likeliest replies on an otherwise idle engine
+        self.ponder = ponder
+        self.ponder_moves = ponder_moves
+        # shallow full strength search that guesses the human's replies
+        self.ponder_limit = chess.engine.Limit(depth=10)
+        # id() of a CPU game -> its PonderState
+        self.ponder_states: dict[int, PonderState] = {}
+        self.ponder_stats = {"hits": 0, "misses": 0, "searches": 0}
+        # draw offers are decided from the evaluation recorded with the CPU's last move, searching briefly only if it's out of date
+        self.draw_limit = chess.engine.Limit(depth=12, time=0.25)
+        self.evaluation_stats = {"snapshots": 0, "searches": 0}
+        # id() of the CPU games the engine is searching for right now
+        self.thinking: set[int] = set()
+        self.recognizer_resource = LazyResource("speech recognizer", sr.Recognizer)
+        self.guild_data_resource = LazyResource("guild settings", load_guild_data)
+        self.sprites_resource = LazyResource("piece sprites", get_pieces)
+        self.warm_on_ready = warm_on_ready
+        # number of active games past which boards are rendered smaller; 0 never shrinks them
+        self.adaptive_render_threshold = adaptive_render_threshold
+        # fractions of the guild's board size used past the threshold, largest first
+        self.render_scales = (0.75, 0.5)
+        self.ready_at: float = None
+
+        # number of encoded board images kept for repeated positions
+        board_image_cache.resize(image_cache_size)
+        # boards are rendered off the event loop; use a dedicated pool if one was asked for, otherwise the loop's default executor
+        if render_workers or render_processes:
+            configure_render_executor(render_workers, render_processes)
+        # numpy is only needed for the numpy backend, so only import it when it is asked for
+        if render_backend == "numpy":
+            from numpy_board_image import NumpyChessBoardImage
+            DiscordChessGame.board_image_class = NumpyChessBoardImage
 
         self.vc_connections = {}
-        self.timer = 0
-        # speech recognition object
-        self.recognizer = sr.Recognizer()
-        
-        # TODO: Investigate more dynamic way of checking audio, ie. check if user is currently talking
-        # self.sink: discord.sinks.MP3Sink
+        # recognitions of voice moves in progress, kept so they aren't garbage collected and their errors get reported
+        self.voice_tasks: set[asyncio.Task] = set()
+        # totals over every voice recording, plus time spent waiting on speech recognition
+        self.voice_stats = VoiceStats()
 
-        conn = sqlite3.connect("database.db")
-        cur = conn.cursor()
-        cur.execute(f"""
-            CREATE TABLE IF NOT EXISTS guilds (id INT PRIMARY KEY, archive INT, archive_channel INT, category_id INT)
-        """)
-        cur.execute(f"""
-            SELECT * FROM guilds
-        """)
-        results = cur.fetchall()
-        cur.close()
-        conn.close()
+    @property
+    def recognizer(self) -> sr.Recognizer:
+        """Speech recognition object"""
+        return self.recognizer_resource.get()
 
-        for result in results:
-            self.guild_data[result[0]] = GuildInfo(result[1], result[2], result[3])
+    @property
+    def guild_data(self) -> dict[GuildInfo]:
+        return self.guild_data_resource.get()
 
     def set_guild_setting(self, guild_id: int, setting: str, value):
         guild_data: GuildInfo = self.guild_data[guild_id] if self.guild_data.get(guild_id) else GuildInfo()
-        guild_data.__setattr__(setting, value)
+        guild_data.set(setting, value)
         guild_data.update(guild_id)
         self.guild_data[guild_id] = guild_data
 
+    def render_settings(self, game: DiscordChessGame) -> tuple:
+        """Return the (size, format, quality) to render a game's board with: its guild's settings, scaled down while the bot is busy."""
+        guild_data: GuildInfo = self.guild_data.get(game.guild_id) or GuildInfo()
+        size = guild_data.render_size
+
+        # past the threshold, shrink boards as the load grows to keep upload bandwidth flat, down to half size. Only a few
+        # fixed sizes are used, so games keep reusing their rendered frames and cached images while the load shifts
+        active = self.games.active_count()
+        if self.adaptive_render_threshold and active > self.adaptive_render_threshold:
+            load = self.adaptive_render_threshold / active
+            # the largest scale that keeps bandwidth within what the threshold allows, or the smallest there is
+            scale = next((scale for scale in self.render_scales if scale <= load), self.render_scales[-1])
+            # keep sizes a multiple of 8 so squares stay the same size
+            size = max(200, int(size * scale) // 8 * 8)
+
+        return (size, guild_data.render_format, guild_data.render_quality)
+
+    def track_game(self, game: DiscordChessGame):
+        """Add a game to the registry and render it with this bot's settings. Raises GameRegistryFull if there is no room."""
+        self.games.add(game)
+        game.render_settings = lambda: self.render_settings(game)
+
+    def bot_elo(self, game: DiscordChessGame) -> int:
+        """Return the elo the CPU plays at in a CPU game"""
+        return game.black.elo if game.black.user is self.user else game.white.elo
+
+    async def cpu_move(self, game: DiscordChessGame):
+        """Have the engine play the CPU's move in a CPU game. Raises asyncio.TimeoutError if the engine doesn't answer within engine_timeout."""
+        # copy the board, so moves made while the engine thinks don't change the position it was asked about
+        board = game.game.copy()
+        elo = self.bot_elo(game)
+        move, result = await self.find_cpu_move(game, board, elo)
+        game.push(move)
+        if result and result["score"]:
+            # the search's score is what the engine expects after its move, so it evaluates the position the human now faces
+            game.evaluation = (board.ply() + 1, result["score"])
+        if self.ponder and not game.game.is_game_over():
+            self.start_pondering(game)
+
+    def search_limit(self, elo: int) -> chess.engine.Limit:
+        """Return how hard the engine searches for a CPU of this elo: 6 plies at 800 elo, one more every 150 elo up to
+        engine_depth, and never longer than search_budget."""
+        depth = min(max(6 + (elo - 800) // 150, 6), self.engine_depth)
+        return chess.engine.Limit(depth=depth, time=self.search_budget)
+
+    async def timed_search(self, search) -> chess.engine.PlayResult | chess.engine.InfoDict:
+        """Await an engine search, cancelling it after engine_timeout and recording how long it took"""
+        start = time.perf_counter()
+        result = await asyncio.wait_for(search, self.engine_timeout)
+        info = result.info if isinstance(result, chess.engine.PlayResult) else result
+        self.search_telemetry.record(time.perf_counter() - start, info.get("depth"))
+        return result
+
+    async def find_cpu_move(self, game: DiscordChessGame, board: chess.Board, elo: int) -> tuple[chess.Move, dict | None]:
+        """Return the CPU's move in board from the opening book, what was pondered, the result cache, or a new search, in that order,
+        with the engine result it came from, or None for book moves"""
+        if self.opening_book:
+            move = self.opening_book.choose(board, elo)
+            if move:
+                return move, None
+
+        pondering = self.ponder_states.pop(id(game), None)
+        if pondering:
+            answer = pondering.answers.get(board.epd())
+            # an answer that's done or being searched right now is worth waiting for; anything else is a miss
+            if answer is not None and (answer.done() or answer is pondering.current):
+                await asyncio.wait({answer}, timeout=self.engine_timeout)
+            pondering.task.cancel()
+            # only a pondered answer that is actually played counts as a hit
+            if answer is not None and answer.done() and not answer.cancelled() and answer.exception() is None:
+                self.ponder_stats["hits"] += 1
+                result = answer.result()
+                return chess.Move.from_uci(result["move"]), result
+            self.ponder_stats["misses"] += 1
+
+        limit = self.search_limit(elo)
+        key = self.engine_cache.key(board, elo, limit)
+        cached = await self.engine_cache.get(key)
+        if cached and cached["move"]:
+            return chess.Move.from_uci(cached["move"]), cached
+
+        async with self.engine_pool.checkout(id(game)) as slot:
+            engine: chess.engine.UciProtocol = slot.engine
+            # game tells the engine when a search is for a different game than its last, so the same game keeps its hash table
+            played = await self.timed_search(engine.play(board, limit, game=id(game), info=chess.engine.INFO_SCORE, options=strength_options(engine, elo)))
+        result = result_from_info(played.info, played.move)
+        self.engine_cache.put(key, result)
+        return played.move, result
+
+    def start_pondering(self, game: DiscordChessGame):
+        """Start searching the CPU's answers to the human's likeliest replies in the background"""
+        self.stop_pondering(game)
+        state = PonderState()
+        state.task = asyncio.create_task(self.ponder_game(game, game.game.copy(), self.bot_elo(game), state))
+        self.ponder_states[id(game)] = state
+
+    def stop_pondering(self, game: DiscordChessGame):
+        state = self.ponder_states.pop(id(game), None)
+        if state:
+            state.task.cancel()
+
+    async def ponder_game(self, game: DiscordChessGame, board: chess.Board, elo: int, state: PonderState):
+        loop = asyncio.get_running_loop()
+        try:
+            # only ponder on an engine nobody else needs, keeping one free for CPU moves in other games
+            async with self.engine_pool.checkout(id(game), reserve=1) as slot:
+                if slot is None:
+                    return
+                engine: chess.engine.UciProtocol = slot.engine
+                # at full strength, since this guesses what the human plays, not what the CPU would
+                lines = await asyncio.wait_for(engine.analyse(board, self.ponder_limit, multipv=self.ponder_moves, game=id(game), options=strength_options(engine)), self.engine_timeout)
+                replies = []
+                for line in lines:
+                    if line.get("pv"):
+                        reply = board.copy()
+                        reply.push(line["pv"][0])
+                        state.answers[reply.epd()] = loop.create_future()
+                        replies.append(reply)
+
+                limit = self.search_limit(elo)
+                for reply in replies:
+                    # give the engine up as soon as a CPU move in another game is waiting for one; the rest count as misses
+                    if self.engine_pool.waiters:
+                        break
+                    state.current = state.answers[reply.epd()]
+                    played = await asyncio.wait_for(engine.play(reply, limit, game=id(game), info=chess.engine.INFO_SCORE, options=strength_options(engine, elo)), self.engine_timeout)
+                    self.ponder_stats["searches"] += 1
+                    result = result_from_info(played.info, played.move)
+                    self.engine_cache.put(self.engine_cache.key(reply, elo, limit), result)
+                    state.current.set_result(result)
+        except Exception as e:
+            # nothing awaits this task, so report anything that goes wrong rather than leave it on the task
+            print(f"Pondering failed in {game}: {e!r}")
+        finally:
+            state.current = None
+            for answer in state.answers.values():
+                if not answer.done():
+                    answer.cancel()
+
+    async def evaluate(self, game: DiscordChessGame) -> dict:
+        """Return the engine's evaluation of a game's position, as a {"type": "cp" or "mate", "value": int} dict from white's side.
+        Uses the evaluation recorded with the CPU's last move if the game hasn't moved on since, otherwise searches for at most draw_limit.
+        Raises asyncio.TimeoutError if the engine doesn't answer within engine_timeout."""
+        board = game.game.copy()
+        if game.evaluation and game.evaluation[0] == board.ply():
+            self.evaluation_stats["snapshots"] += 1
+            return game.evaluation[1]
+
+        self.evaluation_stats["searches"] += 1
+        async with self.engine_pool.checkout(id(game)) as slot:
+            engine: chess.engine.UciProtocol = slot.engine
+            # at full strength, whatever limit the last game to use this engine left set
+            info = await self.timed_search(engine.analyse(board, self.draw_limit, game=id(game), options=strength_options(engine)))
+        score = score_dict(info["score"])
+        game.evaluation = (board.ply(), score)
+        return score
+
+    async def archive_game(self, game: DiscordChessGame):
+        """Post an animated replay of a finished game to its guild's archive channel, if the guild archives games."""
+        guild_data: GuildInfo = self.guild_data.get(game.guild_id)
+        if not guild_data or not guild_data.archive or not guild_data.archive_channel:
+            return
+
+        channel = self.get_channel(int(guild_data.archive_channel))
+        if not channel:
+            return
+
+        replay = await game.get_replay_async()
+        pgn = io.BytesIO(game.get_pgn().encode())
+        await channel.send(f"{game.white.user.display_name} vs. {game.black.user.display_name} ({game.outcome.result()})", files = [discord.File(replay, "replay.gif"), discord.File(pgn, "game.pgn")])
+
     async def on_ready(self):
         print(f'Logged on as {self.user}!')
         self.add_view(CPUGameView())
@@ -198,112 +499,176 @@ class VocalChessClient(discord.Bot):
         self.add_view(GameOfferView())
         await self.change_presence(activity=discord.Game("Chess"))
 
+        # on_ready fires again on every reconnect; only report and warm up after the first login
+        if self.ready_at is None:
+            self.ready_at = time.perf_counter()
+            self.evict_games.start()
+            print(startup_report(self.ready_at))
+            if self.warm_on_ready:
+                asyncio.create_task(self.warm_up())
+
+    async def warm_up(self):
+        """Create every lazy subsystem in the background, then report how long each took."""
+        await asyncio.gather(*(resource.warm() for resource in (self.guild_data_resource, self.sprites_resource, self.recognizer_resource)), self.warm_engines())
+        print(startup_report(self.ready_at))
+
+    async def warm_engines(self):
+        start = time.perf_counter()
+        try:
+            await self.engine_pool.warm()
+        except Exception as e:
+            print(f"Failed to warm up stockfish: {e}")
+        else:
+            startup_timings[f"stockfish x{self.engine_pool.size}"] = time.perf_counter() - start
+
+    async def close(self):
+        # stop pondering, so the engines it holds are returned, then wait for searches in flight before closing the pool
+        states = list(self.ponder_states.values())
+        self.ponder_states.clear()
+        for state in states:
+            state.task.cancel()
+        await asyncio.gather(*(state.task for state in states), return_exceptions=True)
+        await self.engine_pool.close()
+        await asyncio.to_thread(self.engine_cache.close)
+        if self.opening_book:
+            self.opening_book.close()
+        await super().close()
+
     async def on_message(self, message: discord.Message):
-        for game in self.games:
-            if message.channel.id == game.channel and ((message.author.id == game.white.user.id and game.game.turn) or (message.author.id == game.black.user.id and not game.game.turn)):
+        for game in self.games.in_channel(message.channel.id):
+            # games hold their registry slot from before their message is sent; they can't be played until it has been
+            if getattr(game, "ctx", None) is None:
+                continue
+            cpu_game = game.black.user is self.user or game.white.user is self.user
+            if ((message.author.id == game.white.user.id and game.game.turn) or (message.author.id == game.black.user.id and not game.game.turn)):
                 # If the message is in the same channel as the game as the author is the challenger or player, attempt to make a move (if it's a valid move)
                 try:
-                    game.try_move(message.content)
+                    moved = game.try_move(message.content)
                 except Exception as e:
                     await message.reply(f"{e}\nThe /move_help command may help if you are confused.", delete_after=5) 
                 else:
+                    # messages that aren't moves are just chat
+                    if not moved:
+                        continue
                     # if it's a cpu game, make cpu move
-                    if game.black.user is self.user or game.white.user is self.user:
-                        #start = time.time()
-
-                        # set engine elo rating
-                        if game.black.user is self.user:
-                            self.engine.set_elo_rating(game.black.elo)
-                        else:
-                            self.engine.set_elo_rating(game.white.elo)
-
-                        # feed engine the board position
-                        self.engine.set_fen_position(game.game.fen())
-
-                        # get best move from engine
-                        move = self.engine.get_best_move()
-                        #end = time.time()
-                        #print(end - start)
-
-                        # push uci to the game
-                        game.game.push_uci(move)
+                    if cpu_game and not game.game.is_game_over():
+                        await self.play_cpu_turn(game, message)
 
                     # try to end game if it's over
                     game.end_game()
                     if not game.black.bot and not game.white.bot:
                         await message.delete()
                     await game.update_message()
+            elif cpu_game and message.author.id in (game.white.user.id, game.black.user.id) and not game.outcome and id(game) not in self.thinking:
+                # it's the CPU's turn but it isn't thinking, so its last search failed; any message from the player retries it
+                if await self.play_cpu_turn(game, message):
+                    game.end_game()
+                    await game.update_message()
+
+    async def play_cpu_turn(self, game: DiscordChessGame, message: discord.Message) -> bool:
+        """Play the CPU's move in a CPU game, telling the player if the engine couldn't. Returns whether it moved."""
+        self.thinking.add(id(game))
+        try:
+            await self.cpu_move(game)
+        except ENGINE_ERRORS as e:
+            print(f"CPU move failed in {game}: {e!r}")
+            await message.reply(f"{engine_failure_text(e)}; send any message here to have it try again.", delete_after=10)
+            return False
+        finally:
+            self.thinking.discard(id(game))
+        return True
 
     async def on_message_delete(self, message: discord.Message):
-        # if it's an interaction
-        if message.interaction:
-            message_id = message.interaction.id
-            for game in self.games:
-                # if it's one of our games, remove it from the tracker
-                if message_id == game.ctx.interaction.id:
-                    print(f"Deleted {game}")
-                    self.games.remove(game)
-    
-    @tasks.loop(seconds = 1)
+        # if it's one of our games, remove it from the tracker
+        for game in self.games.in_channel(message.channel.id):
+            if getattr(game, "ctx", None) and game.ctx.id == message.id:
+                print(f"Deleted {game}")
+                self.games.remove(game)
+
+    async def on_guild_channel_delete(self, channel: discord.abc.GuildChannel):
+        # games in a deleted channel can never be played again
+        for game in self.games.remove_channel(channel.id):
+            print(f"Channel deleted, dropped {game}")
+
+    @tasks.loop(minutes = 1)
+    async def evict_games(self):
+        """Periodically drop finished and abandoned games so memory doesn't grow with the number of games ever played."""
+        for game in self.games.evict_expired():
+            print(f"Evicted {game}")
+        # forget pondering for games that are gone or over
+        tracked = {id(game) for game in self.games if not game.outcome}
+        for key in [key for key in self.ponder_states if key not in tracked]:
+            self.ponder_states.pop(key).task.cancel()
+
+    @tasks.loop(seconds = 0.1)
     async def check_voice(self, interaction: discord.Interaction, game: DiscordChessGame):
         """
-        Check if Bot detected user voice and give user 
-         x more seconds to talk and then cancels it to 
-         run the callback function "voiceReceiver_callback"
+        Keep recording the voice channel, splitting what each user says into utterances,
+         and end the utterances of users who have stopped talking so they are recognized right away
         """
-        
         vc = get(self.voice_clients, guild=interaction.guild)
+        if game.outcome:
+            self.stop_listening()
+            return
         if not vc.recording:
-            sink = discord.sinks.MP3Sink(filters={'time': 0})
-            # client.sink = sink
-            self.timer = time.time()
-            # print("started recording") 
-            vc.start_recording(sink, self.process_voice, game)
-
-        # if we're recording, check that 5 seconds have past and target user is not currently talking
-        if vc.recording and (time.time()-self.timer >= 5):
-            # print("stopped recording")
-            vc.stop_recording()
-            self.waiting = False     
-
-    def speech_to_text(self, audio_bytes: io.BytesIO | str):
+            sink = UtteranceSink(functools.partial(self.on_utterance, game), asyncio.get_running_loop(), stats=self.voice_stats)
+            vc.start_recording(sink, self.voice_stopped, game)
+        # only keep the audio of the player whose turn it is
+        vc.sink.speaker = game.white.user.id if game.game.turn else game.black.user.id
+        vc.sink.flush()
+
+    def stop_listening(self):
+        """Stop check_voice and the recording it started, so no more utterances are sent to its game"""
+        self.check_voice.stop()
+        for vc in self.voice_clients:
+            if getattr(vc, "recording", False):
+                # the sink would otherwise hand over what's still being said as it shuts down
+                vc.sink.close()
+                vc.stop_recording()
+
+    def speech_to_text(self, audio: sr.AudioData):
         """Convert speech to text using google speech recognition. Gives multiple possibilities."""
-
-        # discord passes oddly formatted, we need to resave it
-        sound_conversion = AudioSegment.from_file(audio_bytes)
-
-        converted_audio = io.BytesIO()
-        sound_conversion.export(converted_audio, format='wav')
-
         text = ""
-        with sr.AudioFile(converted_audio) as source:
-            try:
-                audio_listened = self.recognizer.record(source)
-                try:
-                    text = self.recognizer.recognize_google(audio_listened, language = 'en-US', show_all=True)
+        try:
+            text = self.recognizer.recognize_google(audio, language = 'en-US', show_all=True)
 
-                except sr.UnknownValueError as e:
-                    text = "*inaudible*"
-                except Exception as e: 
-                    print(e)
-            except:
-                text = ""
+        except sr.UnknownValueError as e:
+            text = "*inaudible*"
+        except Exception as e: 
+            print(e)
 
         return text
 
-    async def process_voice(self, sink: discord.sinks.MP3Sink, game: DiscordChessGame, *args):
-        """Process voice after recording is stopped"""    
-        audio_data: io.BytesIO = None
-
-        for user_id, audio in sink.audio_data.items():
-            # if it's the user we're trying to listen to, set their audiodata to the thingy
-            if user_id == (game.white.user.id if game.game.turn else game.black.user.id):
-                audio_data = audio.file
-
-        if not audio_data: return
-
-        # get possibilities from speech_to_text
-        speech_rec = self.speech_to_text(audio_data)
+    def on_utterance(self, game: DiscordChessGame, user_id: int, audio: sr.AudioData):
+        """Called by the voice sink each time someone finishes saying something"""
+        # only the player whose turn it is can move
+        if user_id != (game.white.user.id if game.game.turn else game.black.user.id):
+            return
+        task = asyncio.create_task(self.process_voice(game, audio, game.game.ply()))
+        self.voice_tasks.add(task)
+        task.add_done_callback(self.voice_task_done)
+
+    def voice_task_done(self, task: asyncio.Task):
+        self.voice_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Voice move failed: {task.exception()!r}")
+
+    async def voice_stopped(self, sink: UtteranceSink, game: DiscordChessGame, *args):
+        print(f"Stopped listening to {game}: {sink.stats.snapshot()}")
+
+    async def process_voice(self, game: DiscordChessGame, audio: sr.AudioData, ply: int):
+        """Recognize an utterance the player to move said at ply and try it as their move"""
+        # get possibilities from speech_to_text, off the event loop since it waits on google
+        start = time.perf_counter()
+        speech_rec = await asyncio.to_thread(self.speech_to_text, audio)
+        self.voice_stats.add(recognize_seconds=time.perf_counter() - start)
+
+        # recognitions run side by side, so another utterance may have moved already; this one was meant for a turn that's over
+        if game.game.ply() != ply or game.outcome:
+            return
 
         # pass the list of possibilities to try_speechrec_move
-        await game.try_speechrec_move(speech_rec)
\ No newline at end of file
+        result = await game.try_speechrec_move(speech_rec)
+        if isinstance(result, list):
+            # no move was clearly the best; ask rather than guess
+            await game.ctx.channel.send(f"Did you mean {' or '.join(result)}? Say or type the move again.", delete_after=15)
\ No newline at end of file
@@ -0,0 +1,170 @@
+import asyncio
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import chess
+import chess.engine
+
+def limit_key(limit: chess.engine.Limit) -> str:
+    """Return a stable string for the parts of a search limit that are set, eg. "depth=18"."""
+    return ",".join(f"{name}={value}" for name, value in sorted(vars(limit).items()) if value is not None)
+
+def score_dict(score: chess.engine.PovScore) -> dict:
+    """Convert an engine score to a {"type": "cp" or "mate", "value": int} dict from white's side"""
+    score = score.white()
+    if score.is_mate():
+        return {"type": "mate", "value": score.mate()}
+    return {"type": "cp", "value": score.score()}
+
+def result_from_info(info: dict, move: chess.Move = None) -> dict:
+    """Build a cache entry from the info of a search, and the move it chose if it was a play rather than an analysis."""
+    if move is None and info.get("pv"):
+        move = info["pv"][0]
+    return {
+        "move": move.uci() if move else None,
+        "score": score_dict(info["score"]) if "score" in info else None,
+        "depth": info.get("depth"),
+    }
+
+class EngineResultCache:
+    """Least-recently-used cache of engine results shared by every CPU game, so positions reached again (common
+    openings, a draw offer right after the CPU moved) are answered without a search.
+
+    Keys are (position without move clocks, elo, search limit) and entries are {"move": uci, "score": score_dict,
+    "depth": int}. If path is set, entries are also written to that SQLite database and survive restarts.
+
+    The event loop only touches the in-memory results; the database is read and written on one background thread
+    holding one connection, so lookups and stores never block the loop, and run in the order they were made."""
+    def __init__(self, maxsize: int = 10000, path: str = None, persist_maxsize: int = 100000):
+        self.maxsize = maxsize
+        self.path = path
+        self.persist_maxsize = persist_maxsize
+        self.results: OrderedDict[tuple, dict] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.executor: ThreadPoolExecutor = None
+        # only used on the executor's thread
+        self.conn: sqlite3.Connection = None
+        if path:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="engine-cache")
+            self.executor.submit(self.connect).add_done_callback(self.report_failure)
+
+    def connect(self):
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS engine_results (epd TEXT, elo INT, search TEXT, move TEXT, score_type TEXT, score_value INT, depth INT, used REAL, PRIMARY KEY (epd, elo, search))
+        """)
+        self.conn.commit()
+
+    @staticmethod
+    def report_failure(future):
+        if future.exception() is not None:
+            print(f"Engine cache database error: {future.exception()!r}")
+
+    @staticmethod
+    def key(board: chess.Board, elo: int, limit: chess.engine.Limit) -> tuple:
+        # epd leaves out the halfmove and fullmove clocks, which don't change the best move
+        return (board.epd(), elo, limit_key(limit))
+
+    async def get(self, key: tuple) -> dict | None:
+        """Return the result stored under key, or None if there isn't one."""
+        result = self.results.get(key)
+        if result is not None:
+            self.results.move_to_end(key)
+            self.hits += 1
+            return result
+        if self.path:
+            try:
+                result = await asyncio.get_running_loop().run_in_executor(self.executor, self.load, key)
+            except sqlite3.Error as e:
+                print(f"Engine cache database error: {e!r}")
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.results[key] = result
+        self.resize(self.maxsize)
+        return result
+
+    def put(self, key: tuple, result: dict):
+        """Store a result under key, evicting the least recently used results if the cache is full."""
+        if key in self.results:
+            # keep the deeper of two searches of the same position
+            result = self.merge(self.results[key], result)
+        self.results[key] = result
+        self.results.move_to_end(key)
+        self.resize(self.maxsize)
+        if self.path:
+            self.executor.submit(self.save, key, result).add_done_callback(self.report_failure)
+
+    @staticmethod
+    def merge(old: dict, new: dict) -> dict:
+        """Combine two results for one key, keeping the move and score of the deeper search and filling in any gaps."""
+        if (old.get("depth") or 0) > (new.get("depth") or 0):
+            old, new = new, old
+        return {"move": new["move"] or old["move"], "score": new["score"] or old["score"], "depth": new["depth"]}
+
+    def load(self, key: tuple) -> dict | None:
+        cur = self.conn.cursor()
+        cur.execute("SELECT move, score_type, score_value, depth FROM engine_results WHERE epd = ? AND elo = ? AND search = ?", key)
+        row = cur.fetchone()
+        if row:
+            cur.execute("UPDATE engine_results SET used = ? WHERE epd = ? AND elo = ? AND search = ?", (time.time(), *key))
+            self.conn.commit()
+        cur.close()
+        if not row:
+            return None
+        return {"move": row[0], "score": {"type": row[1], "value": row[2]} if row[1] else None, "depth": row[3]}
+
+    def save(self, key: tuple, result: dict):
+        score = result["score"] or {}
+        cur = self.conn.cursor()
+        cur.execute("""
+            INSERT INTO engine_results (epd, elo, search, move, score_type, score_value, depth, used) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(epd, elo, search) DO UPDATE SET move = excluded.move, score_type = excluded.score_type, score_value = excluded.score_value, depth = excluded.depth, used = excluded.used
+        """, (*key, result["move"], score.get("type"), score.get("value"), result["depth"], time.time()))
+        self.writes += 1
+        # trim the least recently used rows now and then rather than on every write
+        if self.writes % 1000 == 0:
+            cur.execute("DELETE FROM engine_results WHERE rowid IN (SELECT rowid FROM engine_results ORDER BY used DESC LIMIT -1 OFFSET ?)", (self.persist_maxsize,))
+        self.conn.commit()
+        cur.close()
+
+    def close(self):
+        """Finish any pending writes and close the database. Blocks, so call it off the event loop."""
+        if self.executor is None:
+            return
+        self.executor.submit(self.disconnect)
+        self.executor.shutdown(wait=True)
+        self.executor = None
+
+    def disconnect(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def resize(self, maxsize: int):
+        """Change the number of results kept in memory; a maxsize of 0 keeps none, though persisted results are still used."""
+        self.maxsize = maxsize
+        while len(self.results) > self.maxsize:
+            self.results.popitem(last=False)
+
+    def clear(self):
+        self.results.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict:
+        """Return counters for sizing the cache."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self.results),
+            "maxsize": self.maxsize,
+            "persisted": bool(self.path),
+        }
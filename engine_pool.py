@@ -0,0 +1,253 @@
+import asyncio
+import collections
+import contextlib
+import time
+
+import chess.engine
+
+async def open_uci_engine(path: str) -> chess.engine.UciProtocol:
+    """Start a UCI engine as an asyncio subprocess."""
+    _, engine = await chess.engine.popen_uci(path)
+    return engine
+
+async def close_uci_engine(engine: chess.engine.UciProtocol, timeout: float = 5):
+    """Ask an engine to quit, killing it if it doesn't."""
+    try:
+        await asyncio.wait_for(engine.quit(), timeout)
+    except (asyncio.TimeoutError, chess.engine.EngineError):
+        engine.transport.kill()
+
+async def uci_engine_alive(engine: chess.engine.UciProtocol, timeout: float = 5) -> bool:
+    """Return whether an engine's process is running and answers a ping in time."""
+    if engine.returncode.done():
+        return False
+    try:
+        await asyncio.wait_for(engine.ping(), timeout)
+    except (asyncio.TimeoutError, chess.engine.EngineError):
+        return False
+    return True
+
+def strength_options(engine: chess.engine.UciProtocol, elo: int = None) -> dict:
+    """Return the UCI options that limit an engine to elo, clamped to the range it supports, or that lift any limit if
+    elo is None. python-chess keeps options set for a search, so a full strength search has to turn the limit off."""
+    option = engine.options.get("UCI_Elo")
+    if option is None:
+        return {}
+    if elo is None:
+        return {"UCI_LimitStrength": False} if "UCI_LimitStrength" in engine.options else {}
+    return {"UCI_LimitStrength": True, "UCI_Elo": min(max(elo, option.min), option.max)}
+
+class PooledEngine:
+    """One engine process in an EnginePool, with how it has been used."""
+    def __init__(self, index: int, engine):
+        self.index = index
+        self.engine = engine
+        self.uses = 0
+        # affinity key of the last checkout, so the same game can get the same engine and its warm hash table back
+        self.last_key = None
+        # whether the current checkout has the same key as the one before it, so the engine still holds its position
+        self.warm = False
+
+class EnginePool:
+    """A fixed number of engine processes shared by every CPU game, handed out one game at a time.
+
+    open, close and check are coroutine functions that start an engine, shut one down, and return whether one is still
+    usable. Engines are started the first time they are needed; dead engines are restarted before they are handed out."""
+    def __init__(self, open, close, check, size: int = 2, max_affinity_keys: int = 1024):
+        self.open = open
+        self.close_engine = close
+        self.check = check
+        self.size = size
+        self.max_affinity_keys = max_affinity_keys
+        self.slots: list[PooledEngine] = []
+        self.idle: list[PooledEngine] = []
+        # futures of checkouts waiting for an engine, first come first served
+        self.waiters: collections.deque[asyncio.Future] = collections.deque()
+        # affinity key -> index of the engine it last used
+        self.affinity: collections.OrderedDict = collections.OrderedDict()
+        self.starting = 0
+        # set by close; no more engines are handed out once it is
+        self.closed = False
+        self.metrics = {"checkouts": 0, "waited": 0, "wait_seconds": 0.0, "max_queue_depth": 0, "affinity_hits": 0, "restarts": 0}
+
+    @contextlib.asynccontextmanager
+    async def checkout(self, key = None, reserve: int = None):
+        """Borrow a PooledEngine for the duration of an async with block, preferring the one key used last.
+        Waits for one to be checked back in if they are all busy. If reserve is set, doesn't wait, and gives None
+        unless reserve other engines would still be free, for work that shouldn't hold up anyone else."""
+        if reserve is not None and self.available() <= reserve:
+            yield None
+            return
+        slot = await self.acquire(key)
+        failed = False
+        try:
+            yield slot
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            await self.release(slot, failed)
+
+    async def acquire(self, key = None) -> PooledEngine:
+        if self.closed:
+            raise chess.engine.EngineError("the engine pool is closed")
+        start = time.perf_counter()
+        slot = self.take_idle(key)
+        if slot is None and len(self.slots) + self.starting < self.size:
+            slot = await self.start_engine()
+        if slot is None:
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            self.metrics["max_queue_depth"] = max(self.metrics["max_queue_depth"], len(self.waiters))
+            try:
+                slot = await waiter
+            except asyncio.CancelledError:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+                elif waiter.done() and not waiter.cancelled():
+                    # an engine was handed over just as we gave up; pass it on
+                    await self.release(waiter.result())
+                raise
+            self.metrics["waited"] += 1
+            self.metrics["wait_seconds"] += time.perf_counter() - start
+
+        if not await self.healthy(slot):
+            try:
+                await self.restart(slot)
+            except BaseException:
+                await self.release(slot)
+                raise
+        slot.uses += 1
+        slot.warm = key is not None and slot.last_key == key
+        if key is not None:
+            if slot.warm:
+                self.metrics["affinity_hits"] += 1
+            slot.last_key = key
+            self.affinity[key] = slot.index
+            self.affinity.move_to_end(key)
+            while len(self.affinity) > self.max_affinity_keys:
+                self.affinity.popitem(last=False)
+        self.metrics["checkouts"] += 1
+        return slot
+
+    def available(self) -> int:
+        """Return how many engines could be checked out right now without waiting."""
+        return len(self.idle) + self.size - len(self.slots) - self.starting - len(self.waiters)
+
+    def take_idle(self, key = None) -> PooledEngine | None:
+        """Take the idle engine key used last if it's free, otherwise any idle engine."""
+        if not self.idle:
+            return None
+        index = self.affinity.get(key)
+        for slot in self.idle:
+            if slot.index == index:
+                self.idle.remove(slot)
+                return slot
+        return self.idle.pop()
+
+    async def start_engine(self) -> PooledEngine:
+        self.starting += 1
+        try:
+            engine = await self.open()
+        finally:
+            self.starting -= 1
+        slot = PooledEngine(len(self.slots), engine)
+        self.slots.append(slot)
+        return slot
+
+    async def healthy(self, slot: PooledEngine) -> bool:
+        try:
+            return await self.check(slot.engine)
+        except Exception:
+            return False
+
+    async def restart(self, slot: PooledEngine):
+        """Replace a dead or misbehaving engine with a fresh process."""
+        print(f"Restarting engine {slot.index}")
+        try:
+            await self.close_engine(slot.engine)
+        except Exception as e:
+            print(f"Failed to close engine {slot.index}: {e}")
+        slot.engine = await self.open()
+        slot.last_key = None
+        self.metrics["restarts"] += 1
+
+    async def release(self, slot: PooledEngine, failed: bool = False):
+        """Return an engine to the pool, checking it still works first if whoever had it ran into an error."""
+        if failed and not await self.healthy(slot):
+            try:
+                await self.restart(slot)
+            except Exception as e:
+                # leave it dead; the next checkout tries again
+                print(f"Failed to restart engine {slot.index}: {e}")
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(slot)
+                return
+        self.idle.append(slot)
+
+    async def warm(self):
+        """Start every engine now rather than on first use."""
+        while len(self.slots) + self.starting < self.size:
+            await self.release(await self.start_engine())
+
+    async def close(self, timeout: float = 10):
+        """Shut down every engine, waiting up to timeout seconds for checked out engines to be returned first. Engines
+        still out after that are shut down anyway, failing whatever search they were running."""
+        self.closed = True
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_exception(chess.engine.EngineError("the engine pool is closed"))
+        self.waiters.clear()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while (len(self.idle) < len(self.slots) or self.starting) and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        for slot in self.slots:
+            try:
+                await self.close_engine(slot.engine)
+            except Exception as e:
+                print(f"Failed to close engine {slot.index}: {e}")
+        self.slots.clear()
+        self.idle.clear()
+
+    def stats(self) -> dict:
+        """Return the pool's size, how many engines are busy, how many checkouts are waiting, and usage totals."""
+        return {
+            "size": self.size,
+            "started": len(self.slots),
+            "busy": len(self.slots) - len(self.idle),
+            "queue_depth": len(self.waiters),
+            **self.metrics,
+        }
+
+class SearchTelemetry:
+    """Times of the most recent engine searches, to check the CPU stays within its latency budget."""
+    def __init__(self, budget: float, window: int = 1000):
+        self.budget = budget
+        # (seconds, depth reached) of the last window searches
+        self.searches: collections.deque[tuple[float, int]] = collections.deque(maxlen=window)
+        self.total = 0
+        self.over_budget = 0
+
+    def record(self, seconds: float, depth: int = None):
+        self.searches.append((seconds, depth or 0))
+        self.total += 1
+        if seconds > self.budget:
+            self.over_budget += 1
+
+    def stats(self) -> dict:
+        """Return the number of searches, and the median, 95th percentile and slowest time and mean depth of the recent ones."""
+        times = sorted(seconds for seconds, _ in self.searches)
+        if not times:
+            return {"searches": 0, "p50_ms": 0.0, "p95_ms": 0.0, "max_ms": 0.0, "mean_depth": 0.0, "over_budget": 0, "budget_ms": self.budget * 1000}
+        return {
+            "searches": self.total,
+            "p50_ms": times[len(times) // 2] * 1000,
+            "p95_ms": times[min(len(times) - 1, int(len(times) * 0.95))] * 1000,
+            "max_ms": times[-1] * 1000,
+            "mean_depth": sum(depth for _, depth in self.searches) / len(self.searches),
+            "over_budget": self.over_budget,
+            "budget_ms": self.budget * 1000,
+        }
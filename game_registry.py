@@ -0,0 +1,94 @@
+import time
+
+from chess_functions import DiscordChessGame
+
+class GameRegistryFull(Exception):
+    """Raised when a game is added while the registry already holds its maximum number of active games."""
+
+class GameRegistry:
+    """Tracks the games the bot is running, indexed by channel, with a cap on active games and time-based eviction.
+
+    Finished games are evicted finished_ttl seconds after their last update and unfinished games idle_ttl seconds after
+    it, so memory stops growing with the number of games the bot has ever run."""
+    def __init__(self, max_games: int = 500, finished_ttl: float = 15*60, idle_ttl: float = 24*60*60, on_evict = None):
+        self.max_games = max_games
+        self.finished_ttl = finished_ttl
+        self.idle_ttl = idle_ttl
+        # called with each evicted game, eg. to persist it before it is forgotten
+        self.on_evict = on_evict
+        # channel id -> games in that channel; DMs with the bot can hold several CPU games
+        self.channels: dict[int, list[DiscordChessGame]] = {}
+        self.evicted = 0
+
+    def __iter__(self):
+        for games in list(self.channels.values()):
+            yield from list(games)
+
+    def __len__(self):
+        return sum(len(games) for games in self.channels.values())
+
+    def __contains__(self, game: DiscordChessGame):
+        return game in self.channels.get(game.channel, ())
+
+    def active_count(self) -> int:
+        """Return the number of tracked games that haven't finished."""
+        return sum(1 for game in self if not game.outcome)
+
+    def in_channel(self, channel: int) -> list[DiscordChessGame]:
+        """Return a copy of the list of games being played in a channel."""
+        return list(self.channels.get(channel, ()))
+
+    def add(self, game: DiscordChessGame):
+        """Start tracking a game, evicting expired games first if the registry is full. Raises GameRegistryFull if every slot holds an active game."""
+        if len(self) >= self.max_games:
+            self.evict_expired()
+        if len(self) >= self.max_games:
+            # make room by dropping the finished game that has gone longest without an update
+            finished = [g for g in self if g.outcome]
+            if not finished:
+                raise GameRegistryFull(f"There are already {self.max_games} games in progress; try again once one has finished.")
+            self.evict(min(finished, key=lambda g: g.last_active))
+
+        self.channels.setdefault(game.channel, []).append(game)
+
+    def remove(self, game: DiscordChessGame):
+        """Stop tracking a game without calling on_evict; does nothing if it isn't tracked."""
+        games = self.channels.get(game.channel)
+        if games and game in games:
+            games.remove(game)
+            if not games:
+                del self.channels[game.channel]
+
+    def remove_channel(self, channel: int) -> list[DiscordChessGame]:
+        """Stop tracking every game in a channel, eg. because the channel was deleted, and return them."""
+        return self.channels.pop(channel, [])
+
+    def evict(self, game: DiscordChessGame):
+        """Stop tracking a game and hand it to on_evict."""
+        self.remove(game)
+        self.evicted += 1
+        if self.on_evict:
+            try:
+                self.on_evict(game)
+            except Exception as e:
+                print(f"Failed to persist evicted {game}: {e}")
+
+    def evict_expired(self, now: float = None) -> list[DiscordChessGame]:
+        """Evict finished games older than finished_ttl and unfinished games idle for longer than idle_ttl, and return them."""
+        now = now if now is not None else time.monotonic()
+        expired = [game for game in self if now - game.last_active >= (self.finished_ttl if game.outcome else self.idle_ttl)]
+        for game in expired:
+            self.evict(game)
+        return expired
+
+    def memory_report(self) -> dict:
+        """Return the number of tracked games and an estimate of the memory they hold."""
+        games = list(self)
+        return {
+            "games": len(games),
+            "active": sum(1 for game in games if not game.outcome),
+            "finished": sum(1 for game in games if game.outcome),
+            "max_games": self.max_games,
+            "evicted": self.evicted,
+            "bytes": sum(game.memory_usage() for game in games),
+        }
@@ -1,7 +1,7 @@
 from client import *
 import os
 from dotenv import load_dotenv
-from chess_functions import DiscordChessGame, ChessPlayer, piece_aliases
+from chess_functions import DiscordChessGame, ChessPlayer, piece_aliases, upload_stats
 
 def main():
     # load environment variables from .env
@@ -24,7 +24,7 @@ def main():
                         """This bot is programmed to handle a variety of move cases that are not covered by Algebraic Notation or UCI, such as 'Knight to f3', 'En passant', 'Queen side castle', 'Long castles' 'Rook H to f5', et cetera. Unless you are castling or performing en passant, the first word (before space, hyphen, or underscore) **must** be a piece name, which can be followed by a file name if there are multiple legal moves with multiple given pieces (eg. two rooks moving on the same rank, would be 'Rook H to h5'). The last word **must** be the square on which to move, excepting the same circumstances of castling and en passant. For promotion, simply say the word 'promote' or 'promotes' and piece you wish to promote to in the bounds of the first and last word; if you do not specify, it will automatically promote to Queen. Multiple promotion cases that will work are 'e promotes e8', 'e promotes to queen on e8', 'e promotes to knight on e8', 'e promotes knight e8', et cetera."""
                         , inline=False)
         embed.add_field(name="Vocal Chess Moves", value=
-                        """If using the vocal chess features of this bot, it will run through the same checks as if you sent a text message, first checking Algebraic Notation, followed by UCI, followed by the Verbose Chess Moves. Please note that speech recognition can be sensitive, so try to be articulate. Also note that the speech recognizer refreshes every 5 seconds, meaning it may refresh mid-sentence."""
+                        """If using the vocal chess features of this bot, it will run through the same checks as if you sent a text message, first checking Algebraic Notation, followed by UCI, followed by the Verbose Chess Moves. Please note that speech recognition can be sensitive, so try to be articulate. The bot listens for when you stop talking, so pause briefly after saying your move."""
                         , inline=False)
 
         await interaction.response.send_message(embed = embed, ephemeral=True)
@@ -48,7 +48,11 @@ def main():
     @client.command()
     async def setting(interaction: discord.Interaction, setting: discord.Option(str, choices=GuildInfo().__dict__.keys(), description="The thing you want to change"), value: discord.Option()):
         """Set a guild configuration setting"""
-        client.set_guild_setting(interaction.guild_id, setting = setting, value = value)
+        try:
+            client.set_guild_setting(interaction.guild_id, setting = setting, value = value)
+        except ValueError as e:
+            await interaction.response.send_message(f"Could not set {setting}: {e}", ephemeral=True, delete_after=10)
+            return
         await interaction.response.send_message(f"Set {setting} to {value}!", ephemeral=True, delete_after=5)
 
     @discord.guild_only()
@@ -65,6 +69,45 @@ def main():
 
         await interaction.response.send_message(embed = embed, ephemeral=True)
 
+    @client.command()
+    # require admin to see bot internals
+    @discord.default_permissions(administrator=True)
+    async def bot_stats(interaction: discord.Interaction):
+        """Display how many games the bot is tracking and how much memory they and the board image cache hold."""
+        games = client.games.memory_report()
+        images = board_image_cache.stats()
+
+        embed = discord.Embed()
+        embed.set_author(name="VocalChess Statistics")
+        embed.add_field(name="Games", value=f"{games['active']} active / {games['finished']} finished (max {games['max_games']}), {games['evicted']} evicted", inline=False)
+        embed.add_field(name="Game Memory", value=f"~{games['bytes'] / 1024 / 1024:.1f} MB", inline=True)
+        uploads = upload_stats
+        if uploads["uploads"]:
+            embed.add_field(name="Board Uploads", value=f"{uploads['uploads']} uploads, avg {uploads['bytes'] / uploads['uploads'] / 1024:.0f} KB, avg edit {uploads['edit_seconds'] / uploads['uploads'] * 1000:.0f} ms", inline=False)
+        embed.add_field(name="Image Cache", value=f"{images['entries']}/{images['maxsize']} images, {images['bytes'] / 1024 / 1024:.1f} MB, {images['hit_rate']:.0%} hit rate", inline=True)
+        engines = client.engine_pool.stats()
+        average_wait = engines['wait_seconds'] / engines['waited'] * 1000 if engines['waited'] else 0
+        embed.add_field(name="Engines", value=f"{engines['busy']}/{engines['started']} busy (max {engines['size']}), {engines['queue_depth']} waiting (peak {engines['max_queue_depth']}), {engines['checkouts']} searches, avg wait {average_wait:.0f} ms, {engines['restarts']} restarts", inline=False)
+        searches = client.search_telemetry.stats()
+        if searches["searches"]:
+            embed.add_field(name="Engine Searches", value=f"{searches['searches']} searches, p50 {searches['p50_ms']:.0f} ms, p95 {searches['p95_ms']:.0f} ms, max {searches['max_ms']:.0f} ms, mean depth {searches['mean_depth']:.1f}, {searches['over_budget']} over the {searches['budget_ms']:.0f} ms budget", inline=False)
+        results = client.engine_cache.stats()
+        embed.add_field(name="Engine Cache", value=f"{results['entries']}/{results['maxsize']} positions{' (persisted)' if results['persisted'] else ''}, {results['hit_rate']:.0%} hit rate", inline=True)
+        ponder = client.ponder_stats
+        if ponder["hits"] + ponder["misses"]:
+            embed.add_field(name="Pondering", value=f"{ponder['hits']}/{ponder['hits'] + ponder['misses']} CPU replies pondered ({ponder['hits'] / (ponder['hits'] + ponder['misses']):.0%}), {ponder['searches']} searches", inline=True)
+        evaluations = client.evaluation_stats
+        if evaluations["snapshots"] + evaluations["searches"]:
+            embed.add_field(name="Draw Offers", value=f"{evaluations['snapshots']} decided from the CPU's last evaluation, {evaluations['searches']} needed a search", inline=True)
+        voice = client.voice_stats.snapshot()
+        if voice["utterances"]:
+            embed.add_field(name="Voice", value=f"{voice['utterances']} utterances ({voice['seconds']:.0f} s, {voice['bytes'] / 1024:.0f} KB to the recognizer), avg {voice['prepare_seconds'] / voice['utterances'] * 1000:.2f} ms to prepare and {voice['recognize_seconds'] / voice['utterances'] * 1000:.0f} ms to recognize, {(voice['ignored_bytes'] + voice['downmixed_bytes']) / 1024:.0f} KB of other speakers and stereo never kept", inline=False)
+        if client.opening_book:
+            book = client.opening_book.stats()
+            embed.add_field(name="Opening Book", value=f"{book['hits']}/{book['lookups']} CPU moves from the book ({book['hit_rate']:.0%})", inline=True)
+
+        await interaction.response.send_message(embed = embed, ephemeral=True)
+
     @client.command()
     async def clear_dms(interaction: discord.Interaction):
         """Clears the bot DM's; primarily made for OCD debug purposes."""
@@ -93,25 +136,39 @@ def main():
         # create chess game instance
         game = DiscordChessGame(channel = channel.id, white = white_player, black = black_player)
 
+        # add this game to the games so it can be tracked by the discord bot
+        try:
+            client.track_game(game)
+        except GameRegistryFull as error:
+            await interaction.response.send_message(f"{error}", ephemeral=True, delete_after=10)
+            return
+
+        # the CPU's first move can take longer than discord waits for a response
+        await interaction.response.defer(ephemeral=True)
+
         # CPU makes first move if player is black
+        failure = None
         if color == 'black':
-            client.engine.set_elo_rating(elo)
-            # reset board
-            client.engine.set_position(None)
-            move = client.engine.get_best_move()
-            game.game.push_uci(move)
+            # mark the CPU as thinking, like play_cpu_turn does, so a message from the player can't start a second search
+            client.thinking.add(id(game))
+            try:
+                await client.cpu_move(game)
+            except ENGINE_ERRORS as e:
+                # the player can retry it by sending any message in the game
+                print(f"CPU move failed in {game}: {e!r}")
+                failure = f"{engine_failure_text(e)} to make its first move; send any message in the game to have it try again."
+            finally:
+                client.thinking.discard(id(game))
+
+        e = await game.get_embed_async()
 
-        e = game.get_embed()
-
-        # add this game to the games so it can be tracked by the discord bot
-        client.games.append(game)
         view = CPUGameView()
         view.game = game
-        view.engine = client.engine
+        view.client = client
         ctx = await channel.send(file = e['file'], embed = e['embed'], view=view)
         game.ctx = ctx
 
-        await interaction.response.send_message(content = f"A chess game has started in your DMs with this bot!", delete_after = 30, ephemeral = True)
+        await interaction.followup.send(content = f"A chess game has started in your DMs with this bot!{' ' + failure if failure else ''}", delete_after = 30, ephemeral = True)
 
     @discord.guild_only()
     @client.command()
@@ -135,10 +192,10 @@ def main():
     async def leave(interaction: discord.Interaction):
         """Force the bot to leave any channel in this server it's connected to."""
         if interaction.guild.id in client.vc_connections:  # Check if the guild is in the cache.
+            client.stop_listening()
             vc = client.vc_connections[interaction.guild.id]
             await vc.disconnect()
             del client.vc_connections[interaction.guild.id]  # Remove the guild from the cache.
-            client.check_voice.stop()
         else:
             await interaction.response.send_message("VocalChess is currently not in a channel.", ephemeral=True)  # Respond with this if we aren't recording.
 
@@ -0,0 +1,101 @@
+import numpy as np
+from PIL import Image
+
+from board_image import ChessBoardImage, get_label_stamps, get_scaled_pieces, get_square_cell
+
+# caches shared by every render, mirroring the ones in board_image
+_checkerboard_cache: dict = {}
+_sprite_atlas_cache: dict = {}
+_label_cache: dict = {}
+
+def _blend(under: np.ndarray, over, alpha: np.ndarray) -> np.ndarray:
+    """Blend over onto under with 0-255 alpha, rounding the same way PIL does when pasting through a mask."""
+    # the largest intermediate, 255*255 + 128 + 255, still fits in 16 bits
+    mixed = under.astype(np.uint16) * (255 - alpha) + np.asarray(over, dtype=np.uint16) * alpha + 128
+    return (((mixed >> 8) + mixed) >> 8).astype(np.uint8)
+
+def get_checkerboard(size: int = 800, dark: tuple = (110, 109, 107), light: tuple = (144, 143, 141)) -> np.ndarray:
+    """Return the empty board as a (size, size, 3) array, built once per size and colors. Do not modify it; copy it."""
+    key = (size, dark, light)
+    board = _checkerboard_cache.get(key)
+    if board is None:
+        # each pixel is light or dark by the parity of the square it falls in; a8 is always light
+        cells = np.searchsorted(np.arange(8) * size // 8, np.arange(size), side="right") - 1
+        parity = (cells[:, None] + cells[None, :]) % 2
+        board = np.where(parity[:, :, None] == 0, np.array(light, dtype=np.uint8), np.array(dark, dtype=np.uint8))
+        board.setflags(write=False)
+        _checkerboard_cache[key] = board
+    return board
+
+def get_sprite_atlas(pieces: dict, size: int = 800) -> tuple:
+    """Return (symbols, inverse_alpha, premultiplied) for the scaled sprites, where symbols maps a piece symbol to its index in the two (pieces, size//8, size//8, 3) arrays.
+
+    inverse_alpha is 255 - alpha and premultiplied is color * alpha + 128, so blending a sprite only needs one multiply and one add per pixel."""
+    key = (id(pieces), size)
+    atlas = _sprite_atlas_cache.get(key)
+    if atlas is None:
+        scaled = get_scaled_pieces(pieces, size)
+        symbols = {symbol: i for i, symbol in enumerate(scaled)}
+        sprites = np.stack([np.asarray(image.convert("RGBA")) for image in scaled.values()]).astype(np.uint16)
+        alpha = sprites[..., 3:]
+        inverse_alpha = np.broadcast_to(255 - alpha, sprites[..., :3].shape).copy()
+        premultiplied = sprites[..., :3] * alpha + 128
+        atlas = (symbols, inverse_alpha, premultiplied)
+        _sprite_atlas_cache[key] = atlas
+    return atlas
+
+def _blend_sprites(under: np.ndarray, inverse_alpha: np.ndarray, premultiplied: np.ndarray) -> np.ndarray:
+    """Same as _blend, for sprites from get_sprite_atlas; works in place on one buffer to avoid temporaries."""
+    mixed = under.astype(np.uint16)
+    mixed *= inverse_alpha
+    mixed += premultiplied
+    mixed += mixed >> 8
+    mixed >>= 8
+    return mixed.astype(np.uint8)
+
+def get_label_arrays(size: int = 800, mirror: bool = False) -> list:
+    """Return the board_image label stamps as (color, (top, bottom, left, right), alpha) with alpha as a (height, width, 1) array."""
+    key = (size, mirror)
+    labels = _label_cache.get(key)
+    if labels is None:
+        labels = []
+        for stamps in get_label_stamps(size, mirror).values():
+            for color, box, mask in stamps:
+                labels.append((color, (box[1], box[3], box[0], box[2]), np.asarray(mask, dtype=np.uint16)[:, :, None]))
+        _label_cache[key] = labels
+    return labels
+
+class NumpyChessBoardImage:
+    """Draws the same image as ChessBoardImage, but composites the board as an array with every piece blended in one pass."""
+    def __init__(self, pieces: dict, board_position: dict, lastmove: tuple = (), mirror = False, size=800, dark: tuple = (110, 109, 107), light: tuple = (144, 143, 141)):
+        board = get_checkerboard(size, dark, light).copy()
+        tile = size//8
+
+        # highlight last move squares
+        for square in lastmove:
+            column, row = get_square_cell(square, mirror)
+            y, x = row*size//8, column*size//8
+            board[y:y+tile, x:x+tile] = _blend(board[y:y+tile, x:x+tile], ChessBoardImage.highlight[:3], ChessBoardImage.highlight[3])
+
+        # blend every piece at once: gather the squares they stand on, blend the sprites over them and scatter the result back
+        if board_position:
+            symbols, inverse_alpha, premultiplied = get_sprite_atlas(pieces, size)
+            cells = np.array([get_square_cell(square, mirror) for square in board_position])
+            indices = [symbols[piece.symbol()] for piece in board_position.values()]
+            inverse_alpha, premultiplied = inverse_alpha[indices], premultiplied[indices]
+
+            if size % 8 == 0:
+                # squares tile the board exactly, so view it as an 8x8 grid of squares and index whole squares at once
+                squares = board.reshape(8, tile, 8, tile, 3).swapaxes(1, 2)
+                squares[cells[:, 1], cells[:, 0]] = _blend_sprites(squares[cells[:, 1], cells[:, 0]], inverse_alpha, premultiplied)
+            else:
+                offsets = np.arange(tile)
+                ys = (cells[:, 1] * size // 8)[:, None, None] + offsets[None, :, None]
+                xs = (cells[:, 0] * size // 8)[:, None, None] + offsets[None, None, :]
+                board[ys, xs] = _blend_sprites(board[ys, xs], inverse_alpha, premultiplied)
+
+        # draw file and rank markers over everything else
+        for color, (top, bottom, left, right), alpha in get_label_arrays(size, mirror):
+            board[top:bottom, left:right] = _blend(board[top:bottom, left:right], color, alpha)
+
+        self.img = Image.fromarray(board, "RGB")
@@ -0,0 +1,59 @@
+import os
+import random
+
+import chess
+import chess.polyglot
+
+class OpeningBook:
+    """A Polyglot opening book the CPU plays from before it starts searching.
+
+    The book file is memory mapped and looked up by binary search on the position's zobrist hash, so a lookup only
+    touches the few entries for that position no matter how big the book is."""
+    def __init__(self, path: str, max_ply: int = 30, rng: random.Random = None):
+        self.path = path
+        self.max_ply = max_ply
+        self.rng = rng or random.Random()
+        self.reader: chess.polyglot.MemoryMappedReader = None
+        self.lookups = 0
+        self.hits = 0
+
+    def open(self) -> chess.polyglot.MemoryMappedReader:
+        if self.reader is None:
+            self.reader = chess.polyglot.open_reader(self.path)
+        return self.reader
+
+    def book_plies(self, elo: int) -> int:
+        """Return how many plies into the game a CPU of this elo keeps playing book moves; weaker CPUs leave the book sooner."""
+        return min(max(elo // 100, 6), self.max_ply)
+
+    @staticmethod
+    def weights(entries: list, elo: int) -> list[float]:
+        """Return how likely each book move is to be picked by a CPU of this elo. Stronger CPUs stick to the moves the book
+        rates highest; weaker ones spread their choice across everything the book allows."""
+        sharpness = min(max((elo - 800) / 800, 0.25), 2.0)
+        best = max(entry.weight for entry in entries)
+        return [(entry.weight / best) ** sharpness for entry in entries]
+
+    def choose(self, board: chess.Board, elo: int) -> chess.Move | None:
+        """Return a book move for board picked at random by weight, or None if the position isn't in the book or the game is past the book for this elo."""
+        if board.ply() >= self.book_plies(elo):
+            return None
+        self.lookups += 1
+        entries = list(self.open().find_all(board))
+        if not entries:
+            return None
+        self.hits += 1
+        return self.rng.choices(entries, weights=self.weights(entries, elo))[0].move
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def stats(self) -> dict:
+        return {
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+            "bytes": os.path.getsize(self.path) if self.reader is not None else 0,
+        }
@@ -0,0 +1,136 @@
+import io
+import struct
+import zlib
+
+import chess
+from PIL import Image, GifImagePlugin
+
+from board_image import IncrementalBoardRenderer, ChessBoardImage, get_board_background, get_scaled_pieces, get_square_box, get_pieces
+
+# fixed GIF palettes, one per board size
+_palette_cache: dict = {}
+
+def iter_replay_frames(moves: list, size: int = 400, mirror: bool = False, starting_fen: str = chess.STARTING_FEN):
+    """Yield (frame, box) for the starting position and then after each move, where box is the part of frame that differs from the previous one.
+
+    Every frame is the same image repainted in place, so only one board is held in memory; copy or crop it before the next frame is requested."""
+    board = chess.Board(starting_fen)
+    renderer = IncrementalBoardRenderer(get_pieces())
+
+    yield renderer.render(board.piece_map(), (), mirror, size), (0, 0, size, size)
+
+    for move in moves:
+        board.push(move)
+        frame = renderer.render(board.piece_map(), (move.from_square, move.to_square), mirror, size)
+
+        # union of the boxes of every repainted square
+        boxes = [get_square_box(square, size, mirror) for square in renderer.dirty]
+        if boxes:
+            box = (min(b[0] for b in boxes), min(b[1] for b in boxes), max(b[2] for b in boxes), max(b[3] for b in boxes))
+        else:
+            # null moves change nothing, but still take up a frame
+            box = (0, 0, 1, 1)
+        yield frame, box
+
+def get_replay_palette(size: int = 400) -> Image.Image:
+    """Return a "P" mode image holding a palette that covers every color a board of the given size can contain, so all GIF frames can share one global palette."""
+    palette = _palette_cache.get(size)
+    if palette is None:
+        tile = size//8
+        pieces = get_pieces()
+        background = get_board_background(size)
+
+        # every piece on every kind of square, with and without the last move highlight, next to a full board for the markers
+        swatch = Image.new(mode="RGB", size=(max(size, 12*tile), size + 4*tile))
+        swatch.paste(ChessBoardImage(pieces, chess.Board().piece_map(), (chess.E2, chess.E4), size=size).img, (0, 4*tile))
+        square_colors = []
+        for color in (background.getpixel((0, 0)), background.getpixel((tile, 0))):
+            highlighted = Image.new(mode="RGB", size=(tile, tile), color=color)
+            highlighted.paste(ChessBoardImage.highlight[:3], (0, 0, tile, tile), Image.new(mode="L", size=(tile, tile), color=ChessBoardImage.highlight[3]))
+            square_colors += [Image.new(mode="RGB", size=(tile, tile), color=color), highlighted]
+        for row, square in enumerate(square_colors):
+            for column, piece_image in enumerate(get_scaled_pieces(pieces, size).values()):
+                swatch.paste(square, (column*tile, row*tile))
+                swatch.paste(piece_image, (column*tile, row*tile), piece_image)
+
+        palette = swatch.quantize(colors=256, method=Image.Quantize.MEDIANCUT)
+        _palette_cache[size] = palette
+    return palette
+
+def write_replay_gif(fp, moves: list, size: int = 400, mirror: bool = False, duration: int = 800, final_duration: int = 3000, starting_fen: str = chess.STARTING_FEN):
+    """Stream an animated GIF of a game to fp, writing each frame as soon as it is drawn.
+
+    After the first frame, only the region that changed is encoded; earlier frames stay on screen underneath it."""
+    palette = get_replay_palette(size)
+    frames = iter_replay_frames(moves, size, mirror, starting_fen)
+    total = len(moves) + 1
+
+    for i, (frame, box) in enumerate(frames):
+        region = frame.crop(box).quantize(palette=palette, dither=Image.Dither.NONE)
+        if i == 0:
+            header, _ = GifImagePlugin.getheader(region.copy(), info={"loop": 0, "duration": duration})
+            fp.write(b"".join(header))
+        fp.write(b"".join(GifImagePlugin.getdata(region, box[:2], duration=final_duration if i == total - 1 else duration)))
+
+    # trailer
+    fp.write(b";")
+
+def _png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+def _png_image_data(image: Image.Image) -> bytes:
+    """Encode image as a PNG with PIL and return its concatenated IDAT payload."""
+    buffer = io.BytesIO()
+    image.save(buffer, "png", compress_level=1)
+    png = buffer.getvalue()
+
+    data = []
+    # skip the 8 byte signature, then walk the chunks
+    position = 8
+    while position < len(png):
+        length, chunk_type = struct.unpack(">I4s", png[position:position+8])
+        if chunk_type == b"IDAT":
+            data.append(png[position+8:position+8+length])
+        position += 12 + length
+    return b"".join(data)
+
+def write_replay_apng(fp, moves: list, size: int = 400, mirror: bool = False, duration: int = 800, final_duration: int = 3000, starting_fen: str = chess.STARTING_FEN):
+    """Stream an animated PNG of a game to fp, writing each frame as soon as it is drawn.
+
+    After the first frame, only the region that changed is encoded and blended over the previous frame."""
+    frames = iter_replay_frames(moves, size, mirror, starting_fen)
+    total = len(moves) + 1
+    sequence = 0
+
+    fp.write(b"\x89PNG\r\n\x1a\n")
+    # 8 bit truecolor, no interlacing
+    fp.write(_png_chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)))
+    # frame count, loop forever
+    fp.write(_png_chunk(b"acTL", struct.pack(">II", total, 0)))
+
+    for i, (frame, box) in enumerate(frames):
+        region = frame.crop(box)
+        delay = final_duration if i == total - 1 else duration
+        # frame control: sequence, width, height, x, y, delay as a fraction of a second, dispose none, blend source
+        fp.write(_png_chunk(b"fcTL", struct.pack(">IIIIIHHBB", sequence, region.width, region.height, box[0], box[1], delay, 1000, 0, 0)))
+        sequence += 1
+
+        data = _png_image_data(region)
+        if i == 0:
+            fp.write(_png_chunk(b"IDAT", data))
+        else:
+            fp.write(_png_chunk(b"fdAT", struct.pack(">I", sequence) + data))
+            sequence += 1
+
+    fp.write(_png_chunk(b"IEND", b""))
+
+def render_replay(moves: list, format: str = "gif", size: int = 400, mirror: bool = False, starting_fen: str = chess.STARTING_FEN) -> bytes:
+    """Return an encoded animated replay of a game. Only takes picklable arguments so it can run in a worker process."""
+    replay_io = io.BytesIO()
+    if format == "gif":
+        write_replay_gif(replay_io, moves, size, mirror, starting_fen=starting_fen)
+    elif format in ("png", "apng"):
+        write_replay_apng(replay_io, moves, size, mirror, starting_fen=starting_fen)
+    else:
+        raise ValueError(f"Unsupported replay format {format!r}; use gif or apng.")
+    return replay_io.getvalue()
@@ -0,0 +1,48 @@
+import asyncio
+import threading
+import time
+
+# when this module was first imported, which is close enough to process start for the startup report
+process_start = time.perf_counter()
+
+# name -> seconds taken to create each LazyResource, in the order they were created
+startup_timings: dict[str, float] = {}
+
+class LazyResource:
+    """Creates a resource with factory the first time it is needed, rather than at import or construction time.
+
+    Safe to use from several threads; the first caller creates the resource and the others wait for it."""
+    def __init__(self, name: str, factory):
+        self.name = name
+        self.factory = factory
+        self.value = None
+        self.ready = False
+        self.lock = threading.Lock()
+
+    def get(self):
+        """Return the resource, creating it if this is the first use."""
+        if not self.ready:
+            with self.lock:
+                if not self.ready:
+                    start = time.perf_counter()
+                    self.value = self.factory()
+                    startup_timings[self.name] = time.perf_counter() - start
+                    self.ready = True
+        return self.value
+
+    async def warm(self):
+        """Create the resource in a worker thread so the event loop keeps running; errors are reported rather than raised, since nothing is waiting on a warm up."""
+        try:
+            await asyncio.to_thread(self.get)
+        except Exception as e:
+            print(f"Failed to warm up {self.name}: {e}")
+
+def startup_report(ready_at: float = None) -> str:
+    """Return a summary of how long startup took and how long each lazily created resource took."""
+    ready_at = ready_at if ready_at is not None else time.perf_counter()
+    lines = [f"Ready {ready_at - process_start:.2f}s after start"]
+    if not startup_timings:
+        lines.append("  nothing created yet")
+    for name, seconds in startup_timings.items():
+        lines.append(f"  {name}: {seconds*1000:.0f}ms")
+    return "\n".join(lines)
@@ -0,0 +1,166 @@
+import collections
+import math
+import operator
+import sys
+import threading
+import time
+from array import array
+
+import discord
+import speech_recognition as sr
+
+# discord sends 20 ms frames of 48 kHz 16-bit stereo PCM; utterances are kept in mono, which is all the recognizer uses
+SAMPLE_RATE = discord.opus.Decoder.SAMPLING_RATE
+CHANNELS = discord.opus.Decoder.CHANNELS
+SAMPLE_WIDTH = 2
+FRAME_SECONDS = discord.opus.Decoder.FRAME_LENGTH / 1000
+FRAME_SIZE = discord.opus.Decoder.FRAME_SIZE
+MONO_FRAME_SIZE = FRAME_SIZE // CHANNELS
+
+def downmix(frame: bytes) -> tuple[bytes, float]:
+    """Mix a frame of 16-bit little-endian stereo PCM to mono, returning the mono PCM and its loudness (RMS)."""
+    samples = array("h", frame[:len(frame) - len(frame) % (SAMPLE_WIDTH * CHANNELS)])
+    if sys.byteorder == "big":
+        samples.byteswap()
+    mono = array("h", [(left + right) >> 1 for left, right in zip(samples[0::2], samples[1::2])])
+    loudness = math.sqrt(sum(map(operator.mul, mono, mono)) / len(mono)) if mono else 0.0
+    if sys.byteorder == "big":
+        mono.byteswap()
+    return mono.tobytes(), loudness
+
+class VoiceStats:
+    """Counters shared by every sink's receiving thread and the recognizer, so they are only changed under a lock."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        # ignored_bytes are other speakers' audio, downmixed_bytes what mixing to mono saved, prepare_seconds the time
+        # spent turning finished utterances into sr.AudioData, and recognize_seconds the time spent waiting on recognition
+        self.counts = {"utterances": 0, "dropped": 0, "seconds": 0.0, "bytes": 0, "ignored_bytes": 0, "downmixed_bytes": 0, "prepare_seconds": 0.0, "recognize_seconds": 0.0}
+
+    def add(self, **counts):
+        with self.lock:
+            for name, value in counts.items():
+                self.counts[name] += value
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return dict(self.counts)
+
+class SpeakerState:
+    """Where one speaker is in an utterance."""
+    def __init__(self, buffer_size: int, preroll_frames: int):
+        # mono PCM of the current utterance; allocated once and reused, so recording doesn't allocate per frame
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.length = 0
+        # the last few quiet frames before speech starts, so the first syllable isn't clipped
+        self.preroll: collections.deque[bytes] = collections.deque(maxlen=preroll_frames)
+        self.speaking = False
+        # seconds of loud audio in the current utterance, and frames of quiet since the last loud one
+        self.voiced = 0.0
+        self.quiet_frames = 0
+        # time.monotonic() of the last write, since discord stops sending packets while someone is quiet
+        self.last_write = 0.0
+
+class UtteranceSink(discord.sinks.Sink):
+    """A sink that splits each speaker's audio into utterances with voice activity detection.
+
+    Frames whose loudness (RMS) is at least threshold count as speech. An utterance starts at the first loud frame and
+    ends after silence seconds of quiet, or at max_utterance seconds, and is passed to on_utterance(user_id, audio) on
+    loop straight away as an sr.AudioData of its raw mono PCM, with no encoding in between. Utterances with less than
+    min_speech seconds of speech are dropped as noise. If speaker is set, everyone else's audio is ignored.
+
+    write is called from the voice client's receiving thread; flush must be called regularly from the event loop to end
+    utterances of speakers discord has stopped sending audio for."""
+    def __init__(self, on_utterance, loop, threshold: int = 400, silence: float = 0.5, min_speech: float = 0.25, max_utterance: float = 8.0, preroll: float = 0.2,
+                 stats: VoiceStats = None):
+        super().__init__()
+        self.on_utterance = on_utterance
+        self.loop = loop
+        self.threshold = threshold
+        self.silence_frames = round(silence / FRAME_SECONDS)
+        self.silence = silence
+        self.min_speech = min_speech
+        self.buffer_size = round(max_utterance / FRAME_SECONDS) * MONO_FRAME_SIZE
+        self.preroll_frames = round(preroll / FRAME_SECONDS)
+        # user id of the only speaker to record, or None for everyone; set from the event loop
+        self.speaker: int | None = None
+        self.speakers: dict[int, SpeakerState] = {}
+        self.lock = threading.Lock()
+        # set by close; nothing more is handed over once it is
+        self.closed = False
+        # pass a shared VoiceStats to total the stats of several sinks
+        self.stats = stats if stats is not None else VoiceStats()
+
+    def write(self, data: bytes, user: int):
+        if self.speaker is not None and user != self.speaker:
+            self.stats.add(ignored_bytes=len(data))
+            return
+        with self.lock:
+            state = self.speakers.get(user)
+            if state is None:
+                state = self.speakers[user] = SpeakerState(self.buffer_size, self.preroll_frames)
+            state.last_write = time.monotonic()
+            # writes can hold several frames, as the voice client pads gaps between packets with silence
+            for start in range(0, len(data), FRAME_SIZE):
+                self.add_frame(user, state, data[start:start + FRAME_SIZE])
+        self.stats.add(downmixed_bytes=len(data) // CHANNELS)
+
+    def add_frame(self, user: int, state: SpeakerState, frame: bytes):
+        frame, loudness = downmix(frame)
+        loud = loudness >= self.threshold
+        if not state.speaking:
+            if not loud:
+                state.preroll.append(frame)
+                return
+            state.speaking = True
+            state.length = 0
+            for quiet in state.preroll:
+                self.append(state, quiet)
+            state.preroll.clear()
+            state.voiced = 0.0
+            state.quiet_frames = 0
+
+        self.append(state, frame)
+        if loud:
+            state.voiced += FRAME_SECONDS
+            state.quiet_frames = 0
+        else:
+            state.quiet_frames += 1
+        if state.quiet_frames >= self.silence_frames or state.length + MONO_FRAME_SIZE > self.buffer_size:
+            self.end_utterance(user, state)
+
+    @staticmethod
+    def append(state: SpeakerState, frame: bytes):
+        end = state.length + len(frame)
+        state.view[state.length:end] = frame
+        state.length = end
+
+    def end_utterance(self, user: int, state: SpeakerState):
+        state.speaking = False
+        if self.closed:
+            return
+        if state.voiced < self.min_speech:
+            self.stats.add(dropped=1)
+            return
+        start = time.perf_counter()
+        # the only copy of the utterance, since the buffer is reused for the next one
+        audio = sr.AudioData(bytes(state.view[:state.length]), SAMPLE_RATE, SAMPLE_WIDTH)
+        self.stats.add(prepare_seconds=time.perf_counter() - start, utterances=1, seconds=state.length / (SAMPLE_RATE * SAMPLE_WIDTH), bytes=state.length)
+        self.loop.call_soon_threadsafe(self.on_utterance, user, audio)
+
+    def flush(self):
+        """End the utterances of speakers who have sent nothing for silence seconds."""
+        now = time.monotonic()
+        with self.lock:
+            for user, state in self.speakers.items():
+                if state.speaking and now - state.last_write >= self.silence:
+                    self.end_utterance(user, state)
+
+    def close(self):
+        """Drop any utterances in progress and stop handing over new ones, for when whoever they were for is gone."""
+        with self.lock:
+            self.closed = True
+
+    def cleanup(self):
+        self.flush()
+        super().cleanup()